@@ -213,6 +213,7 @@ def test_slow_docs_build():
     )
 
 
+import time
 from unittest.mock import MagicMock, patch, ANY
 from tom.bot import Bot
 from tom.jenkins import Jenkins
@@ -312,3 +313,110 @@ def _trigger_build(
     print("github_requests: {}".format(github_requests.mock_calls))
     print("jenkins_requests: {}".format(jenkins_requests.mock_calls))
     return github_requests, jenkins_requests
+
+
+def _pull(number, repo="cfengine/core", created_at="2020-01-01T00:00:00Z"):
+    return {
+        "title": "PR {}".format(number),
+        "html_url": "https://github.com/{}/pull/{}".format(repo, number),
+        "comments_url": "https://api.github.com/comments",
+        "user": {"login": "author"},
+        "base": {
+            "repo": {"full_name": repo, "name": repo.split("/")[1]},
+            "ref": "master",
+            "user": {"login": "cfengine"},
+        },
+        "number": number,
+        "url": "https://api.github.com/pulls/{}".format(number),
+        "commits_url": "https://api.github.com/pulls/{}/commits".format(number),
+        "requested_reviewers": [],
+        "created_at": created_at,
+        "updated_at": created_at,
+    }
+
+
+def _mention_bot(tmp_path, **extra_config):
+    mention_config = dict(
+        config,
+        bot_features=["trigger_jenkins_from_gh_comments", "report_open_prs"],
+        mention_intake="notifications",
+        **extra_config
+    )
+    mention_bot = Bot(
+        mention_config, config["secrets_data"], str(tmp_path), False, MagicMock()
+    )
+    mention_bot.handle_comments = MagicMock()
+    return mention_bot
+
+
+def test_quiet_repo_mention(tmp_path):
+    mention_bot = _mention_bot(tmp_path)
+    quiet_since = time.time() - 60
+    # nothing new in quiet repo - only reported
+    mention_bot.handle_pr(_pull(1), [], quiet_since)
+    mention_bot.handle_comments.assert_not_called()
+    assert mention_bot.reports.log_pr.call_count == 1
+    # notification about mention which was replied to - all comments checked
+    mention_bot.handle_pr(_pull(1), None, quiet_since)
+    mention_bot.handle_comments.assert_called_once()
+    assert mention_bot.handle_comments.call_args[0][1:] == ()
+
+
+def test_dormant_repo_mention(tmp_path):
+    mention_bot = _mention_bot(
+        tmp_path,
+        max_repo_poll_interval=3600,
+        repo_maintainers={"cfengine/core": [], "cfengine/dormant": []},
+    )
+    # both repos were polled just now, and nothing happened in them for long
+    mention_bot.scheduler.polled("cfengine/core", [_pull(1)])
+    mention_bot.scheduler.polled(
+        "cfengine/dormant", [_pull(1, "cfengine/dormant"), _pull(3, "cfengine/dormant")]
+    )
+    # PR 3 was merged since then
+    responses = {
+        "/repos/cfengine/core/pulls": [_pull(1), _pull(2)],
+        _pull(1)["url"]: {"state": "open"},
+        _pull(3)["url"]: {"state": "closed"},
+    }
+    mention_bot.github = MagicMock()
+    mention_bot.github.get.side_effect = lambda path: responses[path]
+    mention_bot.notification_poller.poll = MagicMock(
+        return_value={"cfengine/core": {2: None}}
+    )
+    mention_bot.notification_poller.save = MagicMock()
+    handled = []
+    mention_bot.handle_pr = lambda pull, comments, quiet: handled.append(
+        (pull["base"]["repo"]["full_name"], pull["number"], comments, quiet)
+    )
+    mention_bot.run()
+    # repo with a mention is polled even if it's not due, and PR opened
+    # since previous poll is found
+    polled = [call[0][0] for call in mention_bot.github.get.call_args_list]
+    assert "/repos/cfengine/dormant/pulls" not in polled
+    assert "/repos/cfengine/core/pulls" in polled
+    assert ("cfengine/core", 2, None, None) in handled
+    assert ("cfengine/core", 1, [], None) in handled
+    assert (
+        "cfengine/dormant",
+        1,
+        [],
+        mention_bot.scheduler.last_poll("cfengine/dormant"),
+    ) in handled
+    # merged PR remembered from earlier poll is neither reported nor pinged
+    assert ("cfengine/dormant", 3) not in [handled_pr[:2] for handled_pr in handled]
+
+
+def test_notified_mention_priority(tmp_path):
+    mention_bot = _mention_bot(tmp_path, repo_maintainers={"cfengine/core": []})
+    mention_bot.github = MagicMock()
+    mention_bot.github.get.return_value = [_pull(1), _pull(2), _pull(3)]
+    # somebody replied after the mention in PR 3
+    mention_bot.notification_poller.poll = MagicMock(
+        return_value={"cfengine/core": {3: None}}
+    )
+    mention_bot.notification_poller.save = MagicMock()
+    handled = []
+    mention_bot.handle_pr = lambda pull, comments, quiet: handled.append(pull["number"])
+    mention_bot.run()
+    assert handled == [3, 1, 2]
@@ -0,0 +1,100 @@
+import os
+import hashlib
+from unittest.mock import MagicMock
+from tom.cache import JSONCache, TarballCache
+
+data = b"tarball contents " * 1000
+data_sha256 = hashlib.sha256(data).hexdigest()
+
+
+def _response(status_code, content, headers=None):
+    response = MagicMock(status_code=status_code, headers=headers or {})
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [content[:100], content[100:]]
+    return response
+
+
+def test_json_cache(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = JSONCache(path, ttl=60, negative_ttl=0)
+    cache.store("good", "value")
+    cache.store("bad", "error", ok=False)
+    assert cache.lookup("good") == (True, "value")
+    assert cache.lookup("bad") is None
+    assert cache.get("missing", "default") == "default"
+    cache.save()
+    assert JSONCache(path, ttl=60).get("good") == "value"
+    assert JSONCache(path, ttl=0).get("good") is None
+
+
+def test_tarball_cache(tmp_path):
+    sessions = MagicMock()
+    sessions.get.return_value = _response(200, data)
+    cache = TarballCache(str(tmp_path), sessions=sessions)
+    assert cache.sha256("https://example.com/foo.tar.gz") == data_sha256
+    assert cache.sha256("https://example.com/foo.tar.gz") == data_sha256
+    assert sessions.get.call_count == 1
+    with open(cache.object_path(data_sha256), "rb") as f:
+        assert f.read() == data
+
+
+def test_tarball_cache_resume(tmp_path):
+    url = "https://example.com/foo.tar.gz"
+    sessions = MagicMock()
+    sessions.get.return_value = _response(206, data[1000:])
+    cache = TarballCache(str(tmp_path), sessions=sessions)
+    os.makedirs(os.path.dirname(cache.partial_path(url)))
+    with open(cache.partial_path(url), "wb") as f:
+        f.write(data[:1000])
+    assert cache.sha256(url) == data_sha256
+    sessions.get.assert_called_once_with(
+        url, headers={"Range": "bytes=1000-"}, stream=True
+    )
+
+
+def test_tarball_cache_resume_complete(tmp_path):
+    url = "https://example.com/foo.tar.gz"
+    sessions = MagicMock()
+    headers = {"Content-Range": "bytes */{}".format(len(data))}
+    sessions.get.return_value = _response(416, b"", headers)
+    cache = TarballCache(str(tmp_path), sessions=sessions)
+    os.makedirs(os.path.dirname(cache.partial_path(url)))
+    with open(cache.partial_path(url), "wb") as f:
+        f.write(data)
+    assert cache.sha256(url) == data_sha256
+    assert sessions.get.call_count == 1
+    with open(cache.object_path(data_sha256), "rb") as f:
+        assert f.read() == data
+
+
+def test_tarball_cache_resume_mismatch(tmp_path):
+    url = "https://example.com/foo.tar.gz"
+    sessions = MagicMock()
+    headers = {"Content-Range": "bytes */{}".format(len(data))}
+    sessions.get.side_effect = [
+        _response(416, b"", headers),
+        _response(200, data),
+    ]
+    cache = TarballCache(str(tmp_path), sessions=sessions)
+    os.makedirs(os.path.dirname(cache.partial_path(url)))
+    with open(cache.partial_path(url), "wb") as f:
+        f.write(data + b"garbage")  # longer than file on server
+    assert cache.sha256(url) == data_sha256
+    assert sessions.get.call_args_list[1][1]["headers"] == {}
+    with open(cache.object_path(data_sha256), "rb") as f:
+        assert f.read() == data
+
+
+def test_tarball_cache_eviction(tmp_path):
+    sessions = MagicMock()
+    cache = TarballCache(str(tmp_path), max_size=len(data) + 10, sessions=sessions)
+    sessions.get.return_value = _response(200, data)
+    cache.sha256("https://example.com/old.tar.gz")
+    os.utime(cache.object_path(data_sha256), (0, 0))
+    new_data = data + b"new"
+    sessions.get.return_value = _response(200, new_data)
+    new_sha256 = cache.sha256("https://example.com/new.tar.gz")
+    assert not os.path.exists(cache.object_path(data_sha256))
+    assert os.path.exists(cache.object_path(new_sha256))
+    # sha256 of evicted file is still known
+    assert cache.sha256("https://example.com/old.tar.gz") == data_sha256
@@ -0,0 +1,37 @@
+from unittest.mock import MagicMock, patch
+from tom.changelog import ChangelogGenerator
+
+
+def _repo(old_sha, new_sha):
+    repo = MagicMock()
+    repo.rev_parse.side_effect = lambda ref: (
+        old_sha if ref.startswith("3.21.0") else new_sha
+    )
+    return repo
+
+
+@patch("tom.changelog.subprocess")
+def test_changelog_cache(subprocess, tmp_path):
+    subprocess.run.return_value = MagicMock(stdout="\t- Fixed things\n")
+    generator = ChangelogGenerator(
+        MagicMock(), MagicMock(), MagicMock(), "test-user", cache_dir=str(tmp_path)
+    )
+    generator.generator_version = "generator-sha"
+    generator.repos = {"core": _repo("aaa", "bbb")}
+
+    def get_changelog():
+        return generator.get_changelog_for("core", "--repo", "3.21.0", "3.21.x")
+
+    assert get_changelog() == "\t- Fixed things\n"
+    assert get_changelog() == "\t- Fixed things\n"
+    assert subprocess.run.call_count == 1
+
+    # branch moved
+    generator.repos = {"core": _repo("aaa", "ccc")}
+    get_changelog()
+    assert subprocess.run.call_count == 2
+
+    # --enterprise looks at several repos, and nova is missing
+    generator.get_changelog_for("enterprise", "--enterprise", "3.21.0", "3.21.x")
+    generator.get_changelog_for("enterprise", "--enterprise", "3.21.0", "3.21.x")
+    assert subprocess.run.call_count == 4
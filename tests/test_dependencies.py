@@ -0,0 +1,175 @@
+import pytest
+from unittest.mock import MagicMock
+from tom.dependencies import (
+    UpdateChecker,
+    ReleaseMonitoring,
+    ReleaseMonitoringException,
+)
+
+updater = UpdateChecker(MagicMock(), MagicMock(), MagicMock(), "test-user")
+
+
+def _with_existing_urls(urls):
+    checked = []
+
+    def checkfile(url, sha256=False):
+        checked.append(url)
+        return url in urls
+
+    checker = UpdateChecker(MagicMock(), MagicMock(), MagicMock(), "test-user")
+    checker.checkfile = checkfile
+    return checker, checked
+
+
+def test_gallop():
+    for last in [0, 1, 2, 3, 7, 8, 9, 31, 64]:
+        probes = []
+
+        def exists(n):
+            probes.append(n)
+            return n <= last
+
+        assert UpdateChecker.gallop(exists, 64) == last
+        assert len(probes) <= 14
+
+
+def test_get_new_url():
+    assert (
+        updater.get_new_url(
+            "https://download.gnome.org/sources/libxml2/2.9/libxml2-2.9.14.tar.xz",
+            "2.9.14",
+            "2.10.0",
+        )
+        == "https://download.gnome.org/sources/libxml2/2.10/libxml2-2.10.0.tar.xz"
+    )
+
+
+def test_find_new_version_patch():
+    url = "https://example.com/foo-1.2.{}.tar.gz"
+    checker, checked = _with_existing_urls([url.format(i) for i in range(3, 14)])
+    assert checker.find_new_version(url.format(3), "1.2.3", ".") == "1.2.13"
+    assert len(checked) < 10
+
+
+def test_find_new_version_minor():
+    url = "https://example.com/foo-{}.tar.gz"
+    existing = ["1.2.3", "1.2.4", "1.3.0", "1.4.0", "1.4.1"]
+    checker, checked = _with_existing_urls([url.format(v) for v in existing])
+    assert checker.find_new_version(url.format("1.2.3"), "1.2.3", ".") == "1.4.1"
+
+
+def test_find_new_version_letter():
+    url = "https://example.com/openssl-1.0.2{}.tar.gz"
+    checker, checked = _with_existing_urls([url.format(c) for c in "kmlno"])
+    assert checker.find_new_version(url.format("k"), "1.0.2k", "char") == "1.0.2o"
+
+
+def test_find_new_version_nothing_new():
+    checker, checked = _with_existing_urls([])
+    assert (
+        checker.find_new_version("https://example.com/foo-1.2.3.tgz", "1.2.3", ".")
+        == "1.2.3"
+    )
+
+
+def test_release_monitoring_cache(tmp_path):
+    cache_path = str(tmp_path / "release-monitoring.json")
+    monitoring = ReleaseMonitoring(cache_path, ttl=60, negative_ttl=60)
+    responses = {
+        ReleaseMonitoring.url.format(42): {"stable_versions": ["1.2.4", "1.2.3"]},
+        ReleaseMonitoring.url.format(43): {},
+    }
+    monitoring.sessions = MagicMock()
+    monitoring.sessions.get.side_effect = lambda url: MagicMock(
+        json=MagicMock(return_value=responses[url])
+    )
+    monitoring.prefetch([42, 43, 42])
+    assert monitoring.sessions.get.call_count == 2
+
+    monitoring = ReleaseMonitoring(cache_path, ttl=60, negative_ttl=60)
+    monitoring.sessions = MagicMock()
+    assert monitoring.get_version(42) == "1.2.4"
+    with pytest.raises(ReleaseMonitoringException):
+        monitoring.get_version(43)
+    monitoring.sessions.get.assert_not_called()
+
+
+def test_updates_matrix():
+    files = {
+        "upstream/3.21.x": {
+            "build-scripts/compile-options": 'var_append DEPS "zlib pcre2"',
+            "deps-packaging/zlib/distfiles": "abc  zlib-1.2.13.tar.gz",
+            "deps-packaging/zlib/source": "https://zlib.net/",
+            "deps-packaging/pcre2/distfiles": "abc  pcre2-10.40.tar.gz",
+            "deps-packaging/pcre2/source": "https://example.com/",
+            "deps-packaging/release-monitoring.json": '{"zlib": 5303}',
+        },
+        "upstream/master": {
+            "build-scripts/compile-options": 'var_append DEPS "zlib"',
+            "deps-packaging/zlib/distfiles": "abc  zlib-1.2.13.tar.gz",
+            "deps-packaging/zlib/source": "https://zlib.net/",
+            "deps-packaging/release-monitoring.json": '{"zlib": 5303}',
+        },
+    }
+    checker = UpdateChecker(MagicMock(), MagicMock(), MagicMock(), "test-user")
+    checker.buildscripts = MagicMock()
+    checker.buildscripts.get_file.side_effect = lambda path, ref: files[ref][path]
+    checker.monitoring = MagicMock()
+    lookups = []
+
+    def get_new_version(dep, old_url, old_version, separator):
+        lookups.append(dep)
+        return {"zlib": "1.3.1", "pcre2": "10.40"}[dep]
+
+    checker.get_new_version = get_new_version
+    branches = ["3.21.x", "master"]
+    matrix = checker.get_updates_matrix(branches)
+    assert sorted(lookups) == ["pcre2", "zlib"]
+    assert matrix == {
+        "zlib": {"3.21.x": ("1.2.13", "1.3.1"), "master": ("1.2.13", "1.3.1")},
+        "pcre2": {"3.21.x": ("10.40", "10.40")},
+    }
+    assert checker.format_matrix(branches, matrix) == (
+        "Dependency | 3.21.x          | master\n"
+        + "zlib       | 1.2.13 -> 1.3.1 | 1.2.13 -> 1.3.1"
+    )
+
+
+def test_probe_cache(tmp_path):
+    def make_checker(**kwargs):
+        checker = UpdateChecker(
+            MagicMock(), MagicMock(), MagicMock(), "test-user", str(tmp_path), **kwargs
+        )
+        checker.sessions = MagicMock()
+        statuses = {"1.2.3": 200, "1.2.4": 404, "1.2.5": 503}
+        checker.sessions.head.side_effect = lambda url: MagicMock(
+            status_code=next(code for v, code in statuses.items() if v in url)
+        )
+        return checker
+
+    checker = make_checker()
+    assert checker.checkfile("https://example.com/foo-1.2.3.tgz")
+    assert not checker.checkfile("https://example.com/foo-1.2.4.tgz")
+    assert not checker.checkfile("https://example.com/foo-1.2.4.tgz")
+    assert checker.sessions.head.call_count == 2
+    # transient errors are not cached
+    assert not checker.checkfile("https://example.com/foo-1.2.5.tgz")
+    assert not checker.checkfile("https://example.com/foo-1.2.5.tgz")
+    assert checker.sessions.head.call_count == 4
+    checker.probes.save()
+
+    checker = make_checker()
+    assert checker.checkfile("https://example.com/foo-1.2.3.tgz")
+    assert not checker.checkfile("https://example.com/foo-1.2.4.tgz")
+    checker.sessions.head.assert_not_called()
+    # files are always downloaded when sha256 is needed
+    checker.tarballs = MagicMock()
+    checker.tarballs.sha256.return_value = "abc"
+    assert checker.checkfile("https://example.com/foo-1.2.3.tgz", True) == "abc"
+    assert checker.checkfile("https://example.com/foo-1.2.4.tgz", True) == "abc"
+
+    # missing files are checked again after probe_negative_ttl
+    checker = make_checker(probe_negative_ttl=0)
+    assert checker.checkfile("https://example.com/foo-1.2.3.tgz")
+    assert not checker.checkfile("https://example.com/foo-1.2.4.tgz")
+    checker.sessions.head.assert_called_once_with("https://example.com/foo-1.2.4.tgz")
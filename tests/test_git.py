@@ -0,0 +1,224 @@
+import os
+import subprocess
+import pytest
+from unittest.mock import patch, MagicMock
+from tom.git import GitRepo, RepoSet, RepoPreparationException
+from tom.gitbackend import CLIBackend, get_backend
+
+
+def _git(path, *args):
+    subprocess.run(
+        [
+            "git",
+            "-C",
+            str(path),
+            "-c",
+            "user.name=Tom",
+            "-c",
+            "user.email=tom@example.com",
+        ]
+        + list(args),
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path / "repo"
+    path.mkdir()
+    _git(path, "init", "-q", "-b", "master")
+    (path / "file.txt").write_text("first\n")
+    _git(path, "add", "file.txt")
+    _git(path, "commit", "-q", "-m", "first")
+    _git(path, "tag", "first")
+    (path / "file.txt").write_text("second\n")
+    _git(path, "commit", "-q", "-a", "-m", "second")
+    repo = GitRepo(str(path), "repo", "cfengine", "cf-bottom")
+    yield repo
+    repo.close()
+
+
+def test_get_file_from_ref(repo):
+    assert repo.get_file("file.txt") == "second\n"
+    assert repo.get_file("file.txt", ref="first") == "first\n"
+    assert repo.get_file("file.txt", ref="master") == "second\n"
+    with pytest.raises(FileNotFoundError):
+        repo.get_file("missing.txt", ref="master")
+    assert repo.get_file("file.txt", ref="master~1") == "first\n"
+
+
+@patch("tom.git.GitRepo")
+def test_repo_set(git_repo):
+    git_repo.side_effect = lambda dirname, **kwargs: dirname
+    repos = RepoSet("..", ["core", "nova"], "cfengine", "cf-bottom").prepare()
+    assert repos == ["../core", "../nova"]
+    git_repo.assert_any_call(
+        dirname="../nova",
+        repo_name="nova",
+        upstream_name="cfengine",
+        my_name="cf-bottom",
+    )
+
+
+@patch("tom.git.GitRepo")
+def test_repo_set_failure(git_repo):
+    def prepare(dirname, **kwargs):
+        if dirname != "../core":
+            raise subprocess.CalledProcessError(128, ["git", "clone"])
+        return dirname
+
+    git_repo.side_effect = prepare
+    with pytest.raises(RepoPreparationException) as e:
+        RepoSet("..", ["core", "nova", "enterprise"], "cfengine", "me").prepare()
+    assert "nova" in str(e.value) or "enterprise" in str(e.value)
+    assert "core" not in str(e.value)
+
+
+def test_worktree(repo):
+    with repo.worktree("first", "from-first") as worktree:
+        assert worktree.get_file("file.txt") == "first\n"
+        worktree.put_file("file.txt", "changed\n")
+        worktree.run_command(
+            "-c",
+            "user.name=Tom",
+            "-c",
+            "user.email=tom@example.com",
+            "commit",
+            "-qm",
+            "x",
+        )
+        assert os.path.exists(worktree.dirname + ".lease")
+    assert not os.path.exists(worktree.dirname)
+    assert repo.get_file("file.txt") == "second\n"
+    assert repo.get_file("file.txt", ref="from-first") == "changed\n"
+
+
+@pytest.mark.parametrize("lease", ["999999999", "", "garbage"])
+def test_stale_worktree_cleanup(repo, lease):
+    with repo.worktree("master") as worktree:
+        with open(worktree.dirname + ".lease", "w") as f:
+            f.write(lease)  # no such process, or unreadable lease
+        repo.cleanup_worktrees()
+        assert not os.path.exists(worktree.dirname)
+
+
+def test_worktree_lease_written_atomically(repo):
+    real_replace = os.replace
+    with patch("tom.git.os.replace", wraps=real_replace) as replace:
+        with repo.worktree("master") as worktree:
+            lease_path = worktree.dirname + ".lease"
+            with open(lease_path) as f:
+                assert f.read() == str(os.getpid())
+    (tmp_path, target), _ = replace.call_args
+    assert target == lease_path
+    assert os.path.dirname(tmp_path) == os.path.dirname(lease_path)
+    assert not os.path.exists(tmp_path)
+
+
+def test_unleased_worktree_cleanup(repo):
+    root = repo.worktrees_root()
+    os.makedirs(root, exist_ok=True)
+    old = os.path.join(root, "old")
+    fresh = os.path.join(root, "fresh")
+    for path in [old, fresh]:
+        os.mkdir(path)
+    past = os.stat(old).st_mtime - 2 * repo.worktree_grace_period
+    os.utime(old, (past, past))
+    repo.cleanup_worktrees()
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+
+@pytest.fixture
+def identity(monkeypatch):
+    for kind in ["AUTHOR", "COMMITTER"]:
+        monkeypatch.setenv("GIT_{}_NAME".format(kind), "Tom")
+        monkeypatch.setenv("GIT_{}_EMAIL".format(kind), "tom@example.com")
+
+
+def test_transaction(repo, identity):
+    transaction = repo.transaction()
+    transaction.put_file("file.txt", "third\n")
+    transaction.put_file("new.txt", "new\n")
+    assert transaction.get_file("file.txt") == "third\n"
+    assert repo.get_file("file.txt") == "second\n"  # nothing written yet
+    transaction.commit("third")
+    assert repo.get_file("file.txt", ref="master") == "third\n"
+    assert repo.get_file("new.txt", ref="master") == "new\n"
+
+
+def test_transaction_on_branch(repo, identity):
+    transaction = repo.transaction("from-first", start_point="first")
+    transaction.put_file("file.txt", "changed\n")
+    transaction.put_file("dir/new.txt", "new\n")
+    transaction.commit("changed")
+    transaction.put_file("file.txt", "changed again\n")
+    assert transaction.get_file("dir/new.txt") == "new\n"
+    transaction.commit("changed again")
+    assert repo.get_file("file.txt", ref="from-first") == "changed again\n"
+    assert repo.get_file("dir/new.txt", ref="from-first") == "new\n"
+    assert repo.get_file("file.txt", ref="from-first~1") == "changed\n"
+    assert repo.get_file("file.txt", ref="from-first~2") == "first\n"
+    # working tree and checked out branch are not touched
+    assert repo.get_file("file.txt") == "second\n"
+    assert repo.get_file("file.txt", ref="master") == "second\n"
+
+
+def test_update_submodules(repo):
+    status = ""
+    updates = []
+    run_command = repo.run_command
+
+    def fake_submodules(*command, **kwargs):
+        if command[:2] == ("submodule", "status"):
+            return MagicMock(stdout=status)
+        if command[0] == "submodule":
+            updates.append(command)
+            return
+        return run_command(*command, **kwargs)
+
+    repo.run_command = fake_submodules
+    repo.update_submodules()
+    status = " {0} sub (v1)\n {0} lib dir (heads/master)\n".format("1" * 40)
+    repo.update_submodules()
+    assert updates == []
+    # submodule left at wrong commit (like after failed update) is updated,
+    # even if HEAD didn't change
+    status = "+{0} sub (v1)\n {0} lib dir (heads/master)\n".format("1" * 40)
+    repo.update_submodules()
+    assert updates == [("submodule", "update", "--init", "--jobs", "4", "--", "sub")]
+    # not initialized submodules are always updated
+    status = " {0} sub (v1)\n-{0} lib dir\n".format("1" * 40)
+    repo.shallow_submodules = True
+    repo.update_submodules()
+    assert updates[-1][-4:] == ("--depth", "1", "--", "lib dir")
+
+
+@pytest.mark.parametrize("backend", ["cli", "dulwich"])
+def test_backend_reads(repo, backend):
+    if backend == "dulwich":
+        pytest.importorskip("dulwich")
+    _git(repo.dirname, "tag", "-a", "v1", "-m", "v1", "master~1")
+    repo.close()
+    repo.backend = get_backend(backend, repo)
+    assert repo.backend.name == backend
+    cli = CLIBackend(repo)
+    for ref in [
+        "HEAD",
+        "master",
+        "first",
+        "v1",
+        "v1^{commit}",
+        "master:file.txt",
+        "master~1",
+        "master:",
+    ]:
+        assert repo.rev_parse(ref) == cli.rev_parse(ref)
+    assert repo.rev_parse("missing") is None
+    assert repo.describe() == "v1"
+    assert repo.get_file("file.txt", ref="v1") == "first\n"
+    assert repo.get_file("file.txt", ref="master~1") == "first\n"
+    with pytest.raises(FileNotFoundError):
+        repo.get_file("missing.txt", ref="master")
+    cli.close()
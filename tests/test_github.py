@@ -1,6 +1,8 @@
 import os
+from unittest.mock import MagicMock
 from tom.github import GitHub
 from tom.github import PR
+from tom.github import CommentPoller, NotificationPoller, EventWatcher
 from tom.utils import read_json
 
 top_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
@@ -61,3 +63,185 @@ def test_comment_path():
         github.comment_path("test-owner", "test-repo", "test-issue")
         == "/repos/test-owner/test-repo/issues/test-issue/comments"
     )
+
+
+def test_comment_poller(tmp_path):
+    def comment(id, number, created, updated=None):
+        return {
+            "id": id,
+            "issue_url": "https://api.github.com/repos/cfengine/core/issues/%d"
+            % number,
+            "user": {"login": "test-user"},
+            "body": "@cf-bottom jenkins",
+            "created_at": created,
+            "updated_at": updated or created,
+        }
+
+    cache_path = str(tmp_path / "comment-watermarks.json")
+    github = MagicMock()
+    poller = CommentPoller(github, cache_path)
+    github.get_conditional.return_value = MagicMock(
+        headers={"Date": "Mon, 01 Jan 2024 00:00:00 GMT"}
+    )
+    assert poller.poll("cfengine/core", "/repos/cfengine/core") is None
+    github.get.assert_not_called()
+    poller.save()
+
+    poller = CommentPoller(github, cache_path)
+    github.get.return_value = [
+        comment(1, 10, "2023-12-01T00:00:00Z", "2024-01-01T10:00:00Z"),  # edited
+        comment(2, 10, "2024-01-01T11:00:00Z"),
+        comment(3, 11, "2024-01-01T12:00:00Z"),
+    ]
+    new = poller.poll("cfengine/core", "/repos/cfengine/core")
+    assert {number: [c.data["id"] for c in cs] for number, cs in new.items()} == {
+        10: [2],
+        11: [3],
+    }
+    github.get.assert_called_once_with(
+        "/repos/cfengine/core/issues/comments?since=2024-01-01T00:00:00Z"
+        + "&sort=updated&direction=asc&per_page=100"
+    )
+    poller.save()
+
+    # comments updated exactly at the watermark are returned again
+    poller = CommentPoller(github, cache_path)
+    github.get.return_value = [
+        comment(3, 11, "2024-01-01T12:00:00Z"),
+        comment(4, 11, "2024-01-01T12:00:00Z"),
+    ]
+    new = poller.poll("cfengine/core", "/repos/cfengine/core")
+    assert [c.data["id"] for c in new[11]] == [4]
+    assert "since=2024-01-01T12:00:00Z" in github.get.call_args[0][0]
+
+    # watermark isn't moved when handling of comments failed
+    poller.failed("cfengine/core")
+    poller.save()
+    poller = CommentPoller(github, cache_path)
+    new = poller.poll("cfengine/core", "/repos/cfengine/core")
+    assert [c.data["id"] for c in new[11]] == [4]
+
+
+def test_notification_poller(tmp_path):
+    def notification(id, reason, number, comment_id):
+        url = "https://api.github.com/repos/cfengine/core/pulls/%d" % number
+        return {
+            "id": id,
+            "reason": reason,
+            "repository": {"full_name": "cfengine/core"},
+            "subject": {
+                "type": "PullRequest",
+                "url": url,
+                "latest_comment_url": "/comments/%d" % comment_id,
+            },
+        }
+
+    comments = {
+        "/comments/1": {"user": {"login": "a"}, "body": "@cf-bottom jenkins please"},
+        "/comments/2": {"user": {"login": "b"}, "body": "thanks"},
+    }
+    github = MagicMock()
+    github.get.side_effect = lambda url: comments[url]
+    github.get_conditional.return_value = MagicMock(
+        status_code=200,
+        headers={"X-Poll-Interval": "0", "Last-Modified": "yesterday"},
+        json=MagicMock(
+            return_value=[
+                notification("10", "mention", 5, 1),
+                notification("11", "mention", 6, 2),
+                notification("12", "subscribed", 7, 1),
+            ]
+        ),
+    )
+    cache_path = str(tmp_path / "notifications.json")
+    poller = NotificationPoller(github, "cf-bottom", cache_path)
+    mentions = poller.poll()
+    assert list(mentions) == ["cfengine/core"]
+    assert [c.author for c in mentions["cfengine/core"][5]] == ["a"]
+    assert mentions["cfengine/core"][6] is None  # check all comments
+    assert 7 not in mentions["cfengine/core"]
+    # only threads of handled PRs are marked read
+    poller.handled("cfengine/core", 5)
+    poller.handled("cfengine/core", 6, ok=False)
+    poller.mark_read()
+    github.patch.assert_called_once_with("/notifications/threads/10")
+    poller.save()
+
+    # failed PR is polled again, without If-Modified-Since
+    poller = NotificationPoller(github, "cf-bottom", cache_path)
+    assert 6 in poller.poll()["cfengine/core"]
+    github.get_conditional.assert_called_with("/notifications?participating=true", {})
+    poller.handled("cfengine/core", 6)
+    poller.mark_read()
+    poller.save()
+
+    poller = NotificationPoller(github, "cf-bottom", cache_path)
+    github.get_conditional.return_value = MagicMock(status_code=304, headers={})
+    assert poller.poll() == {}
+    github.get_conditional.assert_called_with(
+        "/notifications?participating=true", {"If-Modified-Since": "yesterday"}
+    )
+
+
+def test_event_watcher(tmp_path):
+    cache_path = str(tmp_path / "repo-events.json")
+    github = MagicMock()
+    github.get_conditional.return_value = MagicMock(
+        status_code=200, headers={"ETag": '"abc"', "X-Poll-Interval": "0"}
+    )
+    watcher = EventWatcher(github, cache_path)
+    assert watcher.changed("cfengine/core", "/repos/cfengine/core") is None
+    github.get_conditional.assert_called_once_with(
+        "/repos/cfengine/core/events?per_page=1", {}
+    )
+    watcher.set_pulls("cfengine/core", [{"number": 1}])
+    watcher.save()
+
+    watcher = EventWatcher(github, cache_path)
+    github.get_conditional.return_value = MagicMock(
+        status_code=304, headers={"ETag": '"abc"', "X-Poll-Interval": "60"}
+    )
+    assert watcher.changed("cfengine/core", "/repos/cfengine/core") is not None
+    github.get_conditional.assert_called_with(
+        "/repos/cfengine/core/events?per_page=1", {"If-None-Match": '"abc"'}
+    )
+    assert watcher.pulls("cfengine/core") == [{"number": 1}]
+
+    # not polled again before X-Poll-Interval passes
+    assert watcher.changed("cfengine/core", "/repos/cfengine/core") is not None
+    assert github.get_conditional.call_count == 2
+
+
+def test_comment_poller_repeated_polls(tmp_path):
+    cache_path = str(tmp_path / "comment-watermarks.json")
+    boundary = {
+        "id": 1,
+        "issue_url": "https://api.github.com/repos/cfengine/core/issues/10",
+        "user": {"login": "test-user"},
+        "body": "@cf-bottom jenkins",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-01-01T00:00:00Z",
+    }
+    late = dict(boundary, id=2)  # written in the same second, seen later
+    github = MagicMock()
+    poller = CommentPoller(github, cache_path)
+    poller.watermarks.store(
+        "cfengine/core", {"since": "2024-01-01T00:00:00Z", "seen": [1]}
+    )
+    github.get.return_value = [boundary]
+    for i in range(5):
+        assert poller.poll("cfengine/core", "/repos/cfengine/core") == {}
+        poller.save()
+    assert poller.watermarks.get("cfengine/core")["seen"] == [1]
+
+    # failed run doesn't mark new comment at the boundary as seen
+    github.get.return_value = [boundary, late]
+    new = poller.poll("cfengine/core", "/repos/cfengine/core")
+    assert [c.data["id"] for c in new[10]] == [2]
+    poller.failed("cfengine/core")
+    poller.save()
+    assert poller.watermarks.get("cfengine/core")["seen"] == [1]
+    new = poller.poll("cfengine/core", "/repos/cfengine/core")
+    assert [c.data["id"] for c in new[10]] == [2]
+    poller.save()
+    assert poller.watermarks.get("cfengine/core")["seen"] == [1, 2]
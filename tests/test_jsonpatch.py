@@ -0,0 +1,44 @@
+import json
+import pytest
+from tom.jsonpatch import JSONPatcher
+
+DATA = {
+    "packages": {
+        "3.6.6": {"agent": {"community": {"A": {"url": "https://a"}}}},
+        "3.7.0": {"agent": {}},
+    },
+    "empty": {},
+    "latest_version": {"3.6": "3.6.6"},
+}
+
+
+@pytest.mark.parametrize("indent", [2, 4])
+def test_patch_matches_dumps(indent):
+    patcher = JSONPatcher(json.dumps(DATA, indent=indent), indent)
+    patcher.set(["packages", "3.21.4"], {"agent": {"nova": {"B": {"url": "b"}}}})
+    patcher.set(["packages", "3.6.6", "agent"], [1, 2])
+    patcher.set(["empty", "x"], {"y": "z"})
+    patcher.set(["latest_version", "3.6"], "3.6.7")
+    patcher.set(["new"], 1)
+    assert str(patcher) == json.dumps(patcher.data, indent=indent)
+    assert list(patcher.data["packages"]) == ["3.6.6", "3.7.0", "3.21.4"]
+
+
+def test_patch_keeps_other_text():
+    text = '{"a": {"b": 1},\n\n "c": [1,2,3]}\n'
+    patcher = JSONPatcher(text)
+    patcher.set(["a", "d"], 2)
+    assert str(patcher) == '{"a": {"b": 1,\n    "d": 2},\n\n "c": [1,2,3]}\n'
+    assert json.loads(str(patcher)) == {"a": {"b": 1, "d": 2}, "c": [1, 2, 3]}
+
+
+def test_rewrite():
+    patcher = JSONPatcher('{"a": {}}', rewrite=True)
+    patcher.set(["a", "b"], 1)
+    assert str(patcher) == '{\n  "a": {\n    "b": 1\n  }\n}'
+
+
+def test_missing_parent():
+    patcher = JSONPatcher('{"a": {}}')
+    with pytest.raises(KeyError):
+        patcher.set(["b", "c"], 1)
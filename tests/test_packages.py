@@ -0,0 +1,138 @@
+import time
+import threading
+from unittest.mock import MagicMock, patch
+from tom.packages import PackageMapper, ReleaseFetcher, URLVerifier
+
+RELEASES = {
+    "https://cfengine.com/release-data/%s/releases.json"
+    % product: {
+        "releases": [
+            {
+                "version": "3.21.4",
+                "URL": "https://example.com/%s/3.21.4.json" % product,
+                "lts_branch": "3.21.x",
+                "latest_on_branch": True,
+            },
+            {
+                "version": "3.21.3",
+                "URL": "https://example.com/%s/3.21.3.json" % product,
+                "lts_branch": "3.21.x",
+            },
+        ]
+    }
+    for product in ["community", "enterprise"]
+}
+
+
+def _artifacts(url):
+    return {
+        "artifacts": {
+            "Packages": [
+                {"package": "PACKAGES_x86_64_linux_debian_11", "URL": url + ".deb"},
+                {"package": "PACKAGES_HUB_x86_64_linux_debian_11", "URL": url + ".hub"},
+                {"package": "PACKAGES_VIRTUAL_PACKAGES_masterfiles", "URL": url + ".m"},
+            ]
+        }
+    }
+
+
+def test_release_fetcher_etag(tmp_path):
+    fetcher = ReleaseFetcher(str(tmp_path / "release-data.json"))
+    fetcher.sessions = MagicMock()
+    fetcher.sessions.get.return_value = MagicMock(
+        status_code=200, headers={"ETag": '"abc"'}, json=lambda: {"releases": []}
+    )
+    assert fetcher.get_json("https://example.com/r.json") == {"releases": []}
+    fetcher.sessions.get.assert_called_with("https://example.com/r.json", headers={})
+    fetcher.save()
+
+    fetcher = ReleaseFetcher(str(tmp_path / "release-data.json"))
+    fetcher.sessions = MagicMock()
+    fetcher.sessions.get.return_value = MagicMock(status_code=304)
+    assert fetcher.get_json("https://example.com/r.json") == {"releases": []}
+    fetcher.sessions.get.assert_called_with(
+        "https://example.com/r.json", headers={"If-None-Match": '"abc"'}
+    )
+
+
+def test_release_fetcher_ttl(tmp_path):
+    path = str(tmp_path / "release-data.json")
+    fetcher = ReleaseFetcher(path)
+    fetcher.sessions = MagicMock()
+    fetcher.sessions.get.return_value = MagicMock(
+        status_code=200, headers={"ETag": '"abc"'}, json=lambda: {"releases": []}
+    )
+    fetcher.get_json("https://example.com/old.json")
+    fetcher.get_json("https://example.com/r.json")
+    fetcher.save()
+
+    # a month later, only file which is still requested stays in cache
+    now = time.time()
+    with patch("tom.cache.time.time", return_value=now + fetcher.ttl - 60):
+        fetcher = ReleaseFetcher(path)
+        fetcher.sessions = MagicMock()
+        fetcher.sessions.get.return_value = MagicMock(status_code=304)
+        fetcher.get_json("https://example.com/r.json")
+        fetcher.save()
+    with patch("tom.cache.time.time", return_value=now + fetcher.ttl + 60):
+        fetcher = ReleaseFetcher(path)
+        assert fetcher.cache.get("https://example.com/old.json") is None
+        assert fetcher.cache.get("https://example.com/r.json") is not None
+
+
+def test_get_releases(tmp_path):
+    mapper = PackageMapper(
+        MagicMock(), MagicMock(), MagicMock(), "test-user", str(tmp_path)
+    )
+    requested = []
+
+    def get_json(url):
+        requested.append(url)
+        return RELEASES[url] if url in RELEASES else _artifacts(url)
+
+    mapper.fetcher.get_json = get_json
+    releases = mapper.get_releases(["3.21.x", "3.21.3"])
+    assert len(requested) == 6  # 2 indexes and 4 artifact lists
+    assert [r[:3] for r in releases] == [
+        ("3.21.x", "3.21.x", "3.21.4"),
+        ("3.21.3", "3.21.x", "3.21.3"),
+    ]
+    packages = releases[1][3]
+    assert packages["nova"]["PACKAGES_x86_64_linux_debian_11"] == {
+        "url": "https://example.com/enterprise/3.21.3.json.deb"
+    }
+
+
+def test_url_verifier(tmp_path):
+    lock = threading.Lock()
+    active = {"now": 0, "max": 0}
+
+    def head(url, **kwargs):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.01)
+        with lock:
+            active["now"] -= 1
+        return MagicMock(ok="missing" not in url, status_code=404)
+
+    urls = ["https://example.com/%d.deb" % i for i in range(40)]
+    urls.append("https://example.com/missing.deb")
+    verifier = URLVerifier(str(tmp_path / "verified-urls.json"))
+    verifier.max_per_host = 3
+    verifier.sessions = MagicMock()
+    verifier.sessions.head.side_effect = head
+    assert verifier.verify(urls + urls) == {
+        "https://example.com/missing.deb": "return code 404"
+    }
+    assert verifier.sessions.head.call_count == 41
+    assert active["max"] <= 3
+
+    # verified URLs are not checked again, failed ones are
+    verifier = URLVerifier(str(tmp_path / "verified-urls.json"))
+    verifier.sessions = MagicMock()
+    verifier.sessions.head.side_effect = head
+    assert len(verifier.verify(urls)) == 1
+    verifier.sessions.head.assert_called_once_with(
+        "https://example.com/missing.deb", allow_redirects=True, timeout=30
+    )
@@ -0,0 +1,60 @@
+from tom.readme import DepsReadme
+
+DEPS_PACKAGING_README = """\
+# Dependencies
+
+* [OpenSSL](https://openssl.org/) 1.1.1k
+* [zlib](http://www.zlib.net/) 1.2.11, see also [zlib-ng](https://zlib-ng.org)
+"""
+
+README = """\
+## Dependencies
+
+| CFEngine version | 3.18.x | master |
+| ---------------- | ------ | ------ |
+| [zlib](http://www.zlib.net/) | 1.2.11 | 1.2.11 |
+
+## Hub dependencies
+
+| CFEngine version | 3.18.x | master | Notes |
+| ---------------- | ------ | ------ | ----- |
+| [PHP](http://php.net/) | 7.4.1 | 8.0.1 | web |
+| [apache-hub](https://httpd.apache.org/) | 2.4.1 | 2.4.2 | |
+"""
+
+
+def test_replace_version():
+    readme = DepsReadme(DEPS_PACKAGING_README)
+    readme.replace_version("openssl", "1.1.1k", "1.1.1l")
+    readme.replace_version("zlib", "1.2.11", "1.2.13")
+    readme.replace_version("curl", "7.1", "7.2")
+    assert str(readme) == DEPS_PACKAGING_README.replace("1.1.1k", "1.1.1l").replace(
+        "1.2.11", "1.2.13"
+    )
+
+
+def test_update_tables():
+    readme = DepsReadme(README)
+    deps_table = {
+        "zlib": {"3.21.x": "1.2.13", "master": "1.3"},
+        "php": {"3.21.x": "8.2.10", "master": "8.3.0"},
+        "apache": {"master": "2.4.58"},
+    }
+    readme.update_tables(["3.21.x", "master"], deps_table)
+    assert (
+        str(readme)
+        == """\
+## Dependencies
+
+| CFEngine version | 3.21.x | master |
+| ---------------- | ------ | ------ |
+| [zlib](http://www.zlib.net/) | 1.2.13 | 1.3    |
+
+## Hub dependencies
+
+| CFEngine version | 3.21.x | master | Notes |
+| ---------------- | ------ | ------ | ----- |
+| [PHP](http://php.net/) | 8.2.10 | 8.3.0  | web   |
+| [apache-hub](https://httpd.apache.org/) | -      | 2.4.58 |       |
+"""
+    )
@@ -0,0 +1,48 @@
+import time
+from tom.scheduler import RepoScheduler, WorkQueue, parse_time
+
+
+def _timestamp(seconds_ago):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - seconds_ago))
+
+
+def test_parse_time():
+    assert parse_time("1970-01-02T00:00:00Z") == 24 * 3600
+
+
+def test_scheduler(tmp_path):
+    cache_path = str(tmp_path / "repo-schedule.json")
+    scheduler = RepoScheduler(cache_path, max_interval=3600)
+    assert scheduler.due("cfengine/core")
+    assert scheduler.due("cfengine/dormant")
+    scheduler.polled("cfengine/core", [{"updated_at": _timestamp(60)}])
+    scheduler.polled("cfengine/dormant", [{"updated_at": _timestamp(90 * 24 * 3600)}])
+    scheduler.polled("cfengine/empty", [])
+    scheduler.save()
+
+    scheduler = RepoScheduler(cache_path, max_interval=3600)
+    assert scheduler.interval("cfengine/core") < 60
+    assert scheduler.interval("cfengine/dormant") == 3600
+    assert scheduler.interval("cfengine/empty") == 3600
+    assert not scheduler.due("cfengine/dormant")
+    assert scheduler.pulls("cfengine/empty") == []
+
+    # new comment makes repo hot again
+    scheduler.record_activity("cfengine/dormant", _timestamp(0))
+    assert scheduler.interval("cfengine/dormant") < 60
+
+    # freshness bound
+    scheduler = RepoScheduler(cache_path, max_interval=0)
+    assert scheduler.due("cfengine/dormant")
+
+
+def test_work_queue():
+    queue = WorkQueue()
+    queue.put(WorkQueue.REPORTS, "old")
+    queue.put(WorkQueue.REVIEWS, "review-1")
+    queue.put(WorkQueue.MENTIONS, "mention")
+    queue.put(WorkQueue.REVIEWS, "review-2")
+    assert len(queue) == 4
+    assert list(queue) == ["mention", "review-1", "review-2", "old"]
+    assert {p: len(w) for p, w in queue.waits.items()} == {0: 1, 1: 2, 2: 1}
+    assert queue.summary().splitlines()[0].startswith("mentions: 1 items")
@@ -0,0 +1,67 @@
+from unittest.mock import MagicMock
+from tom.github import PR
+from tom.store import ObjectStore
+
+
+def _commit(sha, email):
+    return {
+        "sha": sha,
+        "commit": {
+            "message": "Commit " + sha,
+            "author": {"email": email},
+            "committer": {"email": email},
+        },
+    }
+
+
+def _pr(github, head_sha):
+    data = {
+        "comments_url": "https://api.github.com/comments",
+        "user": {"login": "author"},
+        "base": {
+            "repo": {"full_name": "cfengine/core", "name": "core"},
+            "ref": "master",
+            "user": {"login": "cfengine"},
+        },
+        "head": {"sha": head_sha},
+        "title": "title",
+        "number": 1,
+        "url": "https://api.github.com/pulls/1",
+        "html_url": "https://github.com/pulls/1",
+        "commits_url": "https://api.github.com/pulls/1/commits",
+        "requested_reviewers": [],
+        "created_at": "2022-01-01T00:00:00Z",
+    }
+    return PR(data, github)
+
+
+def test_store(tmp_path):
+    path = str(tmp_path / "github.sqlite3")
+    store = ObjectStore(path)
+    assert store.get_commits("head") is None
+    commits = [_commit("a" * 40, "a@example.com"), _commit("b" * 40, "b@x.com")]
+    store.put_commits("head", commits)
+    store.put_many("tag", [{"id": 7, "tag": "3.21.0"}])
+    store.put_verdict("head", "emails", "")
+    store.close()
+
+    store = ObjectStore(path)
+    assert store.get_commits("head") == commits
+    assert store.get("commit", "b" * 40) == commits[1]
+    assert store.get("tag", 7) == {"id": 7, "tag": "3.21.0"}
+    assert store.get_verdict("head", "emails") == ""
+    assert store.get_verdict("other", "emails") is None
+
+
+def test_pr_commits_from_store(tmp_path):
+    github = MagicMock(known_repos=[])
+    github.store = ObjectStore(str(tmp_path / "github.sqlite3"))
+    github.get.return_value = [_commit("a" * 40, "a@example.com")]
+    assert _pr(github, "a" * 40).emails == {"a@example.com"}
+    assert _pr(github, "a" * 40).emails == {"a@example.com"}
+    github.get.assert_called_once_with("https://api.github.com/pulls/1/commits")
+
+    # new head - new list of commits
+    github.get.return_value = [_commit("c" * 40, "c@example.com")]
+    assert _pr(github, "c" * 40).emails == {"c@example.com"}
+    assert github.get.call_count == 2
@@ -0,0 +1,99 @@
+import pytest
+import threading
+from unittest.mock import MagicMock
+from tom.tag import Tagger, TagPushException
+
+
+class FakeRepo:
+    def __init__(self, name, remote_tags, fail_push=False, head="HEAD"):
+        self.repo_name = name
+        self.tags = set()
+        self.remote_tags = remote_tags
+        self.fail_push = fail_push
+        self.head = head
+        self.signed_in = []
+
+    def run_command(self, *command, **kwargs):
+        if command[:2] == ("tag", "-s"):
+            self.signed_in.append(threading.current_thread())
+            self.tags.add(command[3])
+        elif command[:2] == ("tag", "-d"):
+            self.tags.discard(command[2])
+        elif command == ("rev-parse", "HEAD"):
+            return MagicMock(stdout="sha-%s\n" % self.head)
+        elif command[0] == "rev-parse":
+            return MagicMock(stdout="sha-%s\n" % command[1])
+        elif command[0] == "ls-remote":
+            ref = command[2]
+            if ref not in self.remote_tags[self.repo_name]:
+                return MagicMock(stdout="")
+            # upstream tags are always at HEAD of the fake repo
+            return MagicMock(stdout="sha-%s\t%s\nsha-HEAD\t%s^{}\n" % (ref, ref, ref))
+        elif command[:3] == ("push", "upstream", "--delete"):
+            self.remote_tags[self.repo_name].discard(command[3])
+
+    def push(self, ref, remote, upstream=True):
+        if self.fail_push:
+            raise Exception("push rejected")
+        self.remote_tags[self.repo_name].add(ref)
+
+
+def _tagger(repos):
+    tagger = Tagger(MagicMock(), MagicMock(), MagicMock(), "cf-bottom")
+    tagger.init_repos = lambda checkout_branch, checkout_tag: repos
+    return tagger
+
+
+def test_add_tag():
+    remote_tags = {"core": set(), "nova": set()}
+    repos = [FakeRepo("core", remote_tags), FakeRepo("nova", remote_tags)]
+    tagger = _tagger(repos)
+    tagger.add_tag("3.24.x", "3.24.1-build2", checkout_branch="3.24.x")
+    assert remote_tags == {
+        "core": {"refs/tags/3.24.1-build2"},
+        "nova": {"refs/tags/3.24.1-build2"},
+    }
+    assert tagger.slack.reply.call_args[0][0].startswith("Tagged 3.24.1-build2 in")
+
+
+def test_add_tag_rollback():
+    remote_tags = {"core": set(), "nova": set(), "masterfiles": set()}
+    repos = [
+        FakeRepo("core", remote_tags),
+        FakeRepo("nova", remote_tags, fail_push=True),
+        FakeRepo("masterfiles", remote_tags),
+    ]
+    with pytest.raises(TagPushException, match="nova: push rejected"):
+        _tagger(repos).add_tag("3.24.x", "3.24.1-build2", checkout_branch="3.24.x")
+    assert remote_tags == {"core": set(), "nova": set(), "masterfiles": set()}
+    assert all(not repo.tags for repo in repos)
+
+
+def test_add_tag_signs_sequentially():
+    remote_tags = {"core": set(), "nova": set()}
+    repos = [FakeRepo("core", remote_tags), FakeRepo("nova", remote_tags)]
+    _tagger(repos).add_tag("3.24.x", "3.24.1-build2", checkout_branch="3.24.x")
+    for repo in repos:
+        assert repo.signed_in == [threading.current_thread()]
+
+
+def test_add_tag_existing_upstream():
+    ref = "refs/tags/3.24.1-build2"
+    remote_tags = {"core": {ref}, "nova": set()}
+    repos = [FakeRepo("core", remote_tags), FakeRepo("nova", remote_tags)]
+    tagger = _tagger(repos)
+    tagger.add_tag("3.24.x", "3.24.1-build2", checkout_branch="3.24.x")
+    assert remote_tags == {"core": {ref}, "nova": {ref}}
+    assert repos[0].tags == set()  # identical tag upstream, nothing to do
+    assert "core: already tagged" in tagger.slack.reply.call_args[0][0]
+
+
+def test_add_tag_existing_upstream_elsewhere():
+    ref = "refs/tags/3.24.1-build2"
+    remote_tags = {"core": set(), "nova": {ref}}
+    repos = [FakeRepo("core", remote_tags), FakeRepo("nova", remote_tags, head="new")]
+    with pytest.raises(TagPushException, match="already exists in upstream nova"):
+        _tagger(repos).add_tag("3.24.x", "3.24.1-build2", checkout_branch="3.24.x")
+    # existing upstream tag is not ours to delete
+    assert remote_tags == {"core": set(), "nova": {ref}}
+    assert all(not repo.tags for repo in repos)
@@ -1,17 +1,30 @@
 import re
+import os
+import time
 import random
+import hashlib
 import datetime
 import logging as log
 from copy import copy
 from typing import Dict
 
-from tom.github import GitHub, GitHubInterface, PR
+from tom.github import (
+    GitHub,
+    GitHubInterface,
+    PR,
+    CommentPoller,
+    NotificationPoller,
+    EventWatcher,
+)
 from tom.jenkins import Jenkins
 from tom.slack import Slack, CommandDispatcher
 from tom.dependencies import UpdateChecker
+from tom.git import GitRepo
 from tom.changelog import ChangelogGenerator
 from tom.packages import PackageMapper
 from tom.tag import Tagger
+from tom.store import ObjectStore
+from tom.scheduler import RepoScheduler, WorkQueue, parse_time
 from tom.utils import confirmation, email_sha256
 
 
@@ -23,6 +36,9 @@ class Bot:
         self.directory = directory
         self.interactive = interactive
         self.reports = reports
+        self.cache_dir = os.path.join(directory, "cache")
+        if "git_backend" in config:
+            GitRepo.default_backend = config["git_backend"]
 
         self.bot_features = config["bot_features"]
 
@@ -45,7 +61,10 @@ class Bot:
                 config["jenkins_url"], config["jenkins_job"], secrets, self.username
             )
 
-        self.github = GitHub(secrets["GITHUB_TOKEN"], self.username, self.jenkins_repos)
+        self.store = ObjectStore(os.path.join(self.cache_dir, "github.sqlite3"))
+        self.github = GitHub(
+            secrets["GITHUB_TOKEN"], self.username, self.jenkins_repos, self.store
+        )
 
         self.slack = Slack(
             read_token=secrets.get("SLACK_READ_TOKEN"),
@@ -56,21 +75,62 @@ class Bot:
         )
         self.dispatcher = CommandDispatcher(self.slack)
 
+        # skip repos where nothing happened since previous run
+        self.check_repo_events = config.get("check_repo_events", False)
+        if self.check_repo_events:
+            self.event_watcher = EventWatcher(
+                self.github, os.path.join(self.cache_dir, "repo-events.json")
+            )
+        # poll quiet repos less often, but at least every N seconds
+        self.scheduler = None
+        if "max_repo_poll_interval" in config:
+            self.scheduler = RepoScheduler(
+                os.path.join(self.cache_dir, "repo-schedule.json"),
+                config["max_repo_poll_interval"],
+            )
+        # how to find new mentions: "comments" of each repo, or
+        # "notifications" of the bot account
+        self.mention_intake = config.get("mention_intake", "comments")
+        if "trigger_jenkins_from_gh_comments" in self.bot_features:
+            if self.mention_intake == "notifications":
+                self.notification_poller = NotificationPoller(
+                    self.github,
+                    self.username,
+                    os.path.join(self.cache_dir, "notifications.json"),
+                )
+            else:
+                self.comment_poller = CommentPoller(
+                    self.github, os.path.join(self.cache_dir, "comment-watermarks.json")
+                )
         if "create_prs_from_slack" in self.bot_features:
             self.github_interface = GitHubInterface(
                 self.github, self.slack, self.dispatcher
             )
         if "update_dependencies" in self.bot_features:
             self.updater = UpdateChecker(
-                self.github, self.slack, self.dispatcher, "Lex-2008"
+                self.github,
+                self.slack,
+                self.dispatcher,
+                "Lex-2008",
+                cache_dir=self.cache_dir,
+                monitoring_ttl=config.get("release_monitoring_ttl"),
+                probe_negative_ttl=config.get("missing_version_ttl"),
             )
         if "generate_changelogs" in self.bot_features:
             self.changelogger = ChangelogGenerator(
-                self.github, self.slack, self.dispatcher, "Lex-2008"
+                self.github,
+                self.slack,
+                self.dispatcher,
+                "Lex-2008",
+                cache_dir=self.cache_dir,
             )
         if "map_packages" in self.bot_features:
             self.package_mapper = PackageMapper(
-                self.github, self.slack, self.dispatcher, "Lex-2008"
+                self.github,
+                self.slack,
+                self.dispatcher,
+                "Lex-2008",
+                cache_dir=self.cache_dir,
             )
         if "tag_builds" in self.bot_features:
             self.tagger = Tagger(self.github, self.slack, self.dispatcher, "Lex-2008")
@@ -139,7 +199,10 @@ class Bot:
                         print("Approved PR: {}".format(pr.title))
                     return
 
-    def check_emails(self, pr):
+    def find_bad_emails(self, pr):
+        """Returns comma-separated list of obfuscated banned emails used in
+        commits of pr, or empty string if there are none
+        """
         log.debug("E-mails: {}".format(pr.emails))
         bad_emails = set()
         for email in pr.emails:
@@ -150,7 +213,24 @@ class Bot:
                 bad_emails.add(email)
 
         obfuscated = [f"{e[0]}***@{e[e.index('@')+1:]}" for e in bad_emails]
-        bad_emails = ",".join(obfuscated)
+        return ",".join(obfuscated)
+
+    def check_emails(self, pr):
+        if pr.head_sha is None:
+            bad_emails = self.find_bad_emails(pr)
+        else:
+            # verdict depends only on commits (which are fixed by head SHA)
+            # and the list of banned emails
+            banned = hashlib.sha256(
+                "\n".join(sorted(self.banned_emails)).encode("utf-8")
+            ).hexdigest()
+            name = "emails:" + banned
+            bad_emails = self.store.get_verdict(pr.head_sha, name)
+            if bad_emails is None:
+                bad_emails = self.find_bad_emails(pr)
+                self.store.put_verdict(pr.head_sha, name, bad_emails)
+            else:
+                log.debug("Found e-mail check result for {}".format(pr.head_sha))
 
         if bad_emails:
             body = f"Please use a company e-mail instead of {bad_emails}"
@@ -285,11 +365,21 @@ class Bot:
         no_comprendo = "I'm not sure I understand, @{}.".format(comment.author)
         self.comment(pr, no_comprendo)
 
-    def handle_comments(self, pr):
-        for comment in reversed(pr.comments):
+    def handle_comments(self, pr, comments=None):
+        """Handles mentions of the bot in comments (all comments of pr by
+        default) which were written after its last comment
+        """
+        if comments is None:
+            comments = pr.comments
+        for comment in reversed(comments):
             if comment.author == self.username:
                 return
             if "@" + self.username in comment:
+                if comment.data.get("created_at"):
+                    latency = time.time() - parse_time(comment.data["created_at"])
+                    log.info(
+                        "Handling mention {:.0f}s after it was written".format(latency)
+                    )
                 self.handle_mention(pr, comment)
 
     def find_reviewers(self, pr):
@@ -316,10 +406,29 @@ class Bot:
 
         pr.reviewer = self.repo_dependabot_maintainers[pr.repo]
 
-    def handle_pr(self, pr):
+    def handle_pr(self, pr, new_comments=None, quiet_since=None):
+        """Args:
+        pr - JSON dict of PR from GitHub API
+        new_comments - list of Comment objects written since last run, or
+            None if they're not known and all comments should be checked
+        quiet_since - time when repo of this PR was last checked, if nothing
+            happened in it since then. Then only time-based rules are applied.
+        """
         log.info("Looking at: {} ({})".format(pr["title"], pr["html_url"]))
 
         pr = PR(pr, self.github)
+        # None means that new comments are not known (or there is a mention
+        # somewhere in them), so they must be checked even in a quiet repo
+        quiet = quiet_since is not None and new_comments == []
+        if quiet:
+            # nothing changed except PR age - see if it became old enough for
+            # reviewer to be pinged since the last check
+            elapsed = datetime.timedelta(seconds=time.time() - quiet_since)
+            if pr.age - elapsed >= datetime.timedelta(days=1):
+                log.info("Nothing happened in {} since last check".format(pr.repo))
+                if "report_open_prs" in self.bot_features:
+                    self.reports.log_pr(pr)
+                return
         if "ping_reviewer_for_new_pr_after_1_day" in self.bot_features:
             self.find_reviewers(pr)
         if "ping_reviewer_dependabot" in self.bot_features:
@@ -329,17 +438,113 @@ class Bot:
             or "ping_reviewer_dependabot" in self.bot_features
         ):
             self.ping_reviewer(pr)
-        if (
-            "check_commit_emails" in self.bot_features
-            or "approve_prs" in self.bot_features
-        ):
-            self.review(pr)
-        if "trigger_jenkins_from_gh_comments" in self.bot_features:
-            self.handle_comments(pr)
+        if not quiet:
+            if (
+                "check_commit_emails" in self.bot_features
+                or "approve_prs" in self.bot_features
+            ):
+                self.review(pr)
+            if "trigger_jenkins_from_gh_comments" in self.bot_features:
+                if new_comments is None:
+                    self.handle_comments(pr)
+                elif new_comments:
+                    self.handle_comments(pr, new_comments)
 
         if "report_open_prs" in self.bot_features:
             self.reports.log_pr(pr)
 
+    def find_new_comments(self, repos, quiet_repos=(), mentions=None):
+        """Returns dict {repo: {PR number: [new comments]}} for given repos
+        ({repo: url}). If new comments of a repo or PR aren't known, there is
+        None instead of a dict or list. Repos in quiet_repos are assumed to
+        have no new comments. In notifications mode, mentions (as returned by
+        NotificationPoller.poll) are used instead.
+        """
+        if self.mention_intake == "notifications":
+            return {repo: mentions.get(repo, {}) for repo in repos}
+        return {
+            repo: {} if repo in quiet_repos else self.comment_poller.poll(repo, url)
+            for repo, url in repos.items()
+        }
+
+    def pr_handled(self, pull, ok):
+        """Updates state of mention polling after PR was handled (ok=True),
+        or handling it failed (ok=False)
+        """
+        if "trigger_jenkins_from_gh_comments" not in self.bot_features:
+            return
+        if self.mention_intake == "notifications":
+            repo = pull["base"]["repo"]["full_name"]
+            self.notification_poller.handled(repo, pull["number"], ok)
+        elif not ok:
+            # new comments of this repo will be returned again next time;
+            # mentions which were handled won't be handled twice, since bot
+            # has answered them
+            self.comment_poller.failed(pull["base"]["repo"]["full_name"])
+
+    def save_comment_pollers(self):
+        """Saves state of mention polling after all PRs were handled"""
+        if self.mention_intake == "notifications":
+            self.notification_poller.mark_read()
+            self.notification_poller.save()
+        else:
+            self.comment_poller.save()
+
+    def get_pulls(self, repo, url, force=False):
+        """Returns tuple (list of open PRs of repo, time of previous check if
+        nothing happened in repo since then, or None). With force=True (like
+        when there are notifications about mentions in repo), list of PRs is
+        always fetched and repo is never reported as quiet.
+        PRs of repos which aren't polled in this run are remembered from an
+        earlier poll, so each of them is checked to be still open.
+        """
+        if self.scheduler is not None:
+            if not force and not self.scheduler.due(repo):
+                log.info("Not polling {} in this run".format(repo))
+                pulls = [
+                    pull for pull in self.scheduler.pulls(repo) if self.is_open(pull)
+                ]
+                return (pulls, self.scheduler.last_poll(repo))
+            (pulls, quiet_since) = self.fetch_pulls(repo, url, force)
+            self.scheduler.polled(repo, pulls)
+            return (pulls, quiet_since)
+        return self.fetch_pulls(repo, url, force)
+
+    def is_open(self, pull):
+        """Checks whether PR remembered from an earlier poll wasn't closed
+        or merged since then
+        """
+        if self.github.get(pull["url"])["state"] == "open":
+            return True
+        log.info("{} was closed since last poll".format(pull["html_url"]))
+        return False
+
+    def fetch_pulls(self, repo, url, force=False):
+        if self.check_repo_events:
+            quiet_since = self.event_watcher.changed(repo, url)
+            if quiet_since is not None and not force:
+                return (self.event_watcher.pulls(repo), quiet_since)
+        log.info("Fetching pull requests for {}".format(repo))
+        pulls = self.github.get(url + "/pulls")
+        if self.check_repo_events:
+            self.event_watcher.set_pulls(repo, pulls)
+        return (pulls, None)
+
+    def get_priority(self, new_comments, quiet_since, notified=False):
+        """Returns WorkQueue priority of a PR: PRs with new mentions (found
+        in new_comments, or notified about) are handled first, then ones
+        which need to be reviewed, and then ones from quiet repos, which are
+        mostly reported
+        """
+        mentioned = notified or any(
+            "@" + self.username in comment for comment in new_comments or []
+        )
+        if mentioned and "trigger_jenkins_from_gh_comments" in self.bot_features:
+            return WorkQueue.MENTIONS
+        if quiet_since is not None:
+            return WorkQueue.REPORTS
+        return WorkQueue.REVIEWS
+
     def run(self):
         self.repos = []
         if self.orgs:
@@ -350,22 +555,60 @@ class Bot:
         for repo in self.repo_maintainers:
             self.repos[repo] = "/repos/" + repo
 
+        # in notifications mode, mentions are known before fetching PRs, so
+        # repos with mentions are never skipped
+        mentions = {}
+        if (
+            "trigger_jenkins_from_gh_comments" in self.bot_features
+            and self.mention_intake == "notifications"
+        ):
+            mentions = self.notification_poller.poll()
+
         self.pulls = []
+        active_repos = {}
+        # {repo: time of previous check} for repos where nothing happened
+        quiet_repos = {}
         for repo, url in self.repos.items():
-            log.info("Fetching pull requests for {}".format(repo))
-            pulls = self.github.get(url + "/pulls")
+            (pulls, quiet_since) = self.get_pulls(repo, url, repo in mentions)
+            if quiet_since is not None:
+                quiet_repos[repo] = quiet_since
             if pulls:
                 self.pulls.extend(pulls)
+                active_repos[repo] = url
+
+        self.new_comments = {}
+        if "trigger_jenkins_from_gh_comments" in self.bot_features:
+            self.new_comments = self.find_new_comments(
+                active_repos, quiet_repos, mentions
+            )
+        if self.scheduler is not None:
+            for repo, prs in self.new_comments.items():
+                for comments in (prs or {}).values():
+                    for comment in comments or []:
+                        created = comment.data["created_at"]
+                        self.scheduler.record_activity(repo, created)
 
         if self.pulls:
             log.info("Found {} open pull requests".format(len(self.pulls)))
         else:
             log.warning("Couldn't find any open pull requests!")
 
-        errs = 0
+        queue = WorkQueue()
         for pull in self.pulls:
+            repo = pull["base"]["repo"]["full_name"]
+            new_comments = self.new_comments.get(repo)
+            if new_comments is not None:
+                new_comments = new_comments.get(pull["number"], [])
+            quiet_since = quiet_repos.get(repo)
+            notified = pull["number"] in mentions.get(repo, {})
+            priority = self.get_priority(new_comments, quiet_since, notified)
+            queue.put(priority, (pull, new_comments, quiet_since))
+
+        errs = 0
+        for pull, new_comments, quiet_since in queue:
             try:
-                self.handle_pr(pull)
+                self.handle_pr(pull, new_comments, quiet_since)
+                self.pr_handled(pull, True)
             except AssertionError:
                 log.error(
                     "AssertionError encountered while handling '{}'".format(
@@ -373,6 +616,14 @@ class Bot:
                     )
                 )
                 errs += 1
+                self.pr_handled(pull, False)
+        if "trigger_jenkins_from_gh_comments" in self.bot_features:
+            self.save_comment_pollers()
+        if self.check_repo_events:
+            self.event_watcher.save()
+        if self.scheduler is not None:
+            self.scheduler.save()
+        log.info("Time spent in queue:\n" + queue.summary())
         if errs == 0:
             log.info("Tom successful")
         else:
@@ -0,0 +1,216 @@
+import os
+import time
+import hashlib
+import threading
+import urllib.request
+import logging as log
+
+from tom.sessions import SessionPool
+from tom.utils import read_json, write_json
+
+
+class JSONCache:
+    """Key-value cache persisted to a JSON file between runs.
+    Every entry remembers when it was stored and whether it was a successful
+    result (ok=True) or a failure (ok=False). Entries older than ttl (or
+    negative_ttl, for failures) are treated as missing. A ttl of None means
+    that entries never expire.
+    Keys must be strings and values must be JSON-serializable.
+    Safe to use from several threads; call save() to write changes to disk.
+    """
+
+    def __init__(self, path, ttl=None, negative_ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._data = read_json(path) or {}
+        self._dirty = False
+
+    def _is_fresh(self, entry, now):
+        ttl = self.ttl if entry["ok"] else self.negative_ttl
+        return ttl is None or now - entry["time"] < ttl
+
+    def lookup(self, key):
+        """Returns tuple (ok, value) for a fresh entry, or None if there is
+        no such entry or it has expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or not self._is_fresh(entry, time.time()):
+                return None
+            return (entry["ok"], entry["value"])
+
+    def get(self, key, default=None):
+        """Returns value of a fresh successful entry, or default"""
+        result = self.lookup(key)
+        if result is None or not result[0]:
+            return default
+        return result[1]
+
+    def store(self, key, value, ok=True):
+        with self._lock:
+            self._data[key] = {"ok": ok, "value": value, "time": time.time()}
+            self._dirty = True
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._dirty = True
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def save(self):
+        """Writes cache to disk (if it was changed), dropping expired entries"""
+        with self._lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            self._data = {
+                key: entry
+                for key, entry in self._data.items()
+                if self._is_fresh(entry, now)
+            }
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # write to a temporary file first, so that concurrently running
+            # processes never read half-written file
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            write_json(self._data, tmp_path, prettify=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+class TarballCache:
+    """Content-addressed cache of downloaded files.
+    Files are stored in `directory` under names equal to their sha256 sums,
+    and an index maps URLs to those sums - so a file is downloaded once, no
+    matter how many times its sha256 is requested. Interrupted downloads are
+    resumed with HTTP Range requests. When total size of stored files grows
+    above max_size, least recently used files are deleted (but their sha256
+    sums stay in the index).
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, directory, max_size=2 * 1024 * 1024 * 1024, sessions=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.sessions = sessions or SessionPool()
+        self.index = JSONCache(os.path.join(directory, "index.json"))
+        self._lock = threading.Lock()
+        self._url_locks = {}
+
+    def object_path(self, sha256):
+        return os.path.join(self.directory, "objects", sha256)
+
+    def partial_path(self, url):
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "partial", name)
+
+    def _url_lock(self, url):
+        with self._lock:
+            if url not in self._url_locks:
+                self._url_locks[url] = threading.Lock()
+            return self._url_locks[url]
+
+    def sha256(self, url):
+        """Returns sha256 sum of a file at given URL, downloading it only if
+        it's not known yet
+        """
+        with self._url_lock(url):
+            sha256 = self.index.get(url)
+            if sha256 is not None:
+                log.debug("sha256 of {} found in cache".format(url))
+                path = self.object_path(sha256)
+                if os.path.exists(path):
+                    os.utime(path)  # mark as recently used
+                return sha256
+            sha256 = self.download(url)
+            self.index.store(url, sha256)
+            self.index.save()
+        self.evict()
+        return sha256
+
+    def download(self, url):
+        """Downloads file to the cache, returns its sha256 sum"""
+        partial_path = self.partial_path(url)
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        if url.startswith("http"):
+            sha256 = self._download_http(url, partial_path)
+        else:
+            sha256 = self._download_urllib(url, partial_path)
+        object_path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(partial_path, object_path)
+        return sha256
+
+    def _download_http(self, url, partial_path):
+        m = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial_path):
+            # resume interrupted download, but first hash what we already have
+            with open(partial_path, "rb") as f:
+                data = f.read(self.chunk_size)
+                while data:
+                    m.update(data)
+                    offset += len(data)
+                    data = f.read(self.chunk_size)
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        with self.sessions.get(url, headers=headers, stream=True) as r:
+            if offset and r.status_code == 416:
+                # nothing left to download - either partial file is complete
+                # (process was interrupted before moving it to objects), or
+                # it's longer than the file on server
+                size = r.headers.get("Content-Range", "").rpartition("/")[2]
+                if size == str(offset):
+                    log.debug("partial download of {} is complete".format(url))
+                    return m.hexdigest()
+                log.debug("discarding partial download of {}".format(url))
+                os.remove(partial_path)
+                return self._download_http(url, partial_path)
+            if offset and r.status_code == 206:
+                log.debug("resuming download of {} from {}".format(url, offset))
+                mode = "ab"
+            else:
+                r.raise_for_status()
+                m = hashlib.sha256()
+                mode = "wb"
+            with open(partial_path, mode) as f:
+                for data in r.iter_content(self.chunk_size):
+                    m.update(data)
+                    f.write(data)
+        return m.hexdigest()
+
+    def _download_urllib(self, url, partial_path):
+        m = hashlib.sha256()
+        with urllib.request.urlopen(url) as r, open(partial_path, "wb") as f:
+            data = r.read(self.chunk_size)
+            while data:
+                m.update(data)
+                f.write(data)
+                data = r.read(self.chunk_size)
+        return m.hexdigest()
+
+    def evict(self):
+        """Deletes least recently used files until total size fits max_size"""
+        objects_dir = os.path.join(self.directory, "objects")
+        with self._lock:
+            try:
+                names = os.listdir(objects_dir)
+            except FileNotFoundError:
+                return
+            files = []
+            for name in names:
+                stat = os.stat(os.path.join(objects_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+            total_size = sum(size for (_, size, _) in files)
+            for mtime, size, name in sorted(files):
+                if total_size <= self.max_size:
+                    break
+                log.debug("evicting {} from tarball cache".format(name))
+                os.remove(os.path.join(objects_dir, name))
+                total_size -= size
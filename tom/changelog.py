@@ -6,7 +6,9 @@ import datetime
 import hashlib
 import urllib.request
 import logging as log
-from tom.git import GitRepo
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tom.cache import JSONCache
+from tom.git import RepoSet
 
 
 class ChangelogException(Exception):
@@ -28,16 +30,30 @@ class ChangelogGenerator:
     """
 
     repos_root = ".."
+    # we need only history of these repos, file contents are fetched on demand
+    clone_filter = "blob:none"
     changelog_filenames = {
         "core": "ChangeLog",
         "enterprise": "ChangeLog.Enterprise",
         "masterfiles": "CHANGELOG.md",
     }
+    # repos which changelog-generator looks at when run with --enterprise
+    enterprise_repo_names = ["enterprise", "nova", "mission-portal"]
 
-    def __init__(self, github, slack, dispatcher, username):
+    # generated changelogs are dropped from cache after this many seconds,
+    # branches move on and old commit ranges are not asked for anymore
+    cache_ttl = 30 * 24 * 60 * 60
+
+    def __init__(self, github, slack, dispatcher, username, cache_dir="."):
         self.github = github
         self.slack = slack
         self.username = username
+        # generated changelogs, by commit ranges they were generated for
+        self.cache = JSONCache(
+            os.path.join(cache_dir, "changelogs.json"), ttl=self.cache_ttl
+        )
+        self.repos = {}
+        self.generator_version = None
         dispatcher.register_command(
             keyword="changelogs",
             callback=lambda branch: self.run(branch),
@@ -100,21 +116,60 @@ class ChangelogGenerator:
                 version_parts = branch_name_parts[0:2] + ["0"]
         return ".".join(version_parts)
 
+    @staticmethod
+    def get_generator_version(core):
+        """Returns SHA of changelog-generator directory tree in core repo,
+        which changes whenever generator changes
+        """
+        return core.rev_parse("HEAD:misc/changelog-generator")
+
+    def get_cache_key(self, name, arg, old_version, branch):
+        """Returns a key under which output of changelog-generator is cached:
+        it consists of generator version and commit SHAs of old_version and
+        branch in all repos which generator looks at. Returns None if some
+        of them can't be found.
+        """
+        if self.generator_version is None:
+            return None
+        repo_names = self.enterprise_repo_names if arg == "--enterprise" else [name]
+        key = [arg, name, self.generator_version]
+        for repo_name in repo_names:
+            if repo_name not in self.repos:
+                return None
+            repo = self.repos[repo_name]
+            old_sha = repo.rev_parse(old_version + "^{commit}")
+            new_sha = repo.rev_parse(branch + "^{commit}")
+            if old_sha is None or new_sha is None:
+                return None
+            key.append("{}:{}...{}".format(repo_name, old_sha, new_sha))
+        return " ".join(key)
+
     def get_changelog_for(self, name, arg, old_version, branch):
-        olddir = os.getcwd()
-        try:
-            os.chdir(os.path.join(self.repos_root, name))
-            cmd = [
-                "../core/misc/changelog-generator/changelog-generator",
-                arg,
-                "{}...{}".format(old_version, branch),
-            ]
-            log.debug("running command: {}".format(" ".join(cmd)))
-            proc = subprocess.run(
-                cmd, stdout=subprocess.PIPE, universal_newlines=True, check=True
+        """Runs changelog-generator in a given repo. Doesn't change working
+        directory of current process, so it's safe to run it from several
+        threads at once. Output is cached, so generator is run again only if
+        commit range (or generator itself) changed.
+        """
+        key = self.get_cache_key(name, arg, old_version, branch)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                log.info("Using cached changelog for {} {}".format(name, arg))
+                return cached
+        generator = os.path.abspath(
+            os.path.join(
+                self.repos_root, "core/misc/changelog-generator/changelog-generator"
             )
-        finally:
-            os.chdir(olddir)
+        )
+        cmd = [generator, arg, "{}...{}".format(old_version, branch)]
+        cwd = os.path.join(self.repos_root, name)
+        log.debug("running command in {}: {}".format(cwd, " ".join(cmd)))
+        proc = subprocess.run(
+            cmd, cwd=cwd, stdout=subprocess.PIPE, universal_newlines=True, check=True
+        )
+        if key is not None:
+            self.cache.store(key, proc.stdout)
+            self.cache.save()
         return proc.stdout
 
     def generate_changelog_in_repo(self, branch, repo):
@@ -152,12 +207,19 @@ class ChangelogGenerator:
             )
         else:
             # generate changelog for all enterprise repos plus buildscipts repo
-            changelog_enterprise = self.get_changelog_for(
-                name, "--enterprise", old_version, branch
-            )
-            changelog_buildscripts = self.get_changelog_for(
-                "buildscripts", "--repo", old_version, branch
-            )
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                changelog_enterprise = pool.submit(
+                    self.get_changelog_for, name, "--enterprise", old_version, branch
+                )
+                changelog_buildscripts = pool.submit(
+                    self.get_changelog_for,
+                    "buildscripts",
+                    "--repo",
+                    old_version,
+                    branch,
+                )
+                changelog_enterprise = changelog_enterprise.result()
+                changelog_buildscripts = changelog_buildscripts.result()
             changelog_contents = (
                 new_version
                 + ":\n"
@@ -198,19 +260,29 @@ class ChangelogGenerator:
             "enterprise",
         ]
         # checkout all repos to the required branch
-        repos = (
-            GitRepo(
-                dirname=os.path.join(self.repos_root, name),
-                repo_name=name,
-                upstream_name="cfengine",
-                my_name=self.username,
-                checkout_branch=branch,
-            )
-            for name in repo_names
-        )
-        # generate changelogs
-        prs = (self.generate_changelog_in_repo(branch, repo) for repo in repos)
-        # currently prs has False elements corresponding to repos which don't
-        # have changelogs. Let's filter them out
-        prs = (x for x in prs if x)
+        repos = RepoSet(
+            self.repos_root,
+            repo_names,
+            upstream_name="cfengine",
+            my_name=self.username,
+            checkout_branch=branch,
+            clone_filter=self.clone_filter,
+        ).prepare()
+        self.repos = {repo.repo_name: repo for repo in repos}
+        self.generator_version = self.get_generator_version(self.repos["core"])
+        # generate changelogs in all repos at once, but only in repos which
+        # have changelogs, and report PRs as soon as they are created
+        repos = [repo for repo in repos if repo.repo_name in self.changelog_filenames]
+        prs = []
+        with ThreadPoolExecutor(max_workers=len(repos)) as pool:
+            futures = {
+                pool.submit(self.generate_changelog_in_repo, branch, repo): repo
+                for repo in repos
+            }
+            for future in as_completed(futures):
+                pr_text = future.result()
+                self.slack.reply(
+                    "Changelog for {}: {}".format(futures[future].repo_name, pr_text)
+                )
+                prs.append(pr_text)
         self.slack.reply("Changelog PRs:\n{}".format("\n".join(prs)), True)
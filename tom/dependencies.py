@@ -1,12 +1,14 @@
 import re
+import os
 import json
-import requests
-import collections
 import datetime
-import hashlib
-import urllib.request
 import logging as log
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
+from tom.cache import JSONCache, TarballCache
 from tom.git import GitRepo
+from tom.readme import DepsReadme
+from tom.sessions import SessionPool
 from tom.utils import pretty
 
 
@@ -22,22 +24,141 @@ class ReleaseMonitoringException(DependencyException):
     pass
 
 
+class ReleaseMonitoring:
+    """Class responsible for getting latest versions of projects from
+    release-monitoring.org. Responses are cached on disk for `ttl` seconds,
+    and failures are cached for `negative_ttl` seconds, so that repeated
+    runs don't query the same project over and over again.
+    """
+
+    url = "https://release-monitoring.org/api/v2/versions/?project_id={}"
+
+    def __init__(self, cache_path, ttl, negative_ttl, workers=8):
+        self.cache = JSONCache(cache_path, ttl, negative_ttl)
+        self.sessions = SessionPool(pool_size=workers)
+        self.workers = workers
+
+    def fetch_version(self, project_id):
+        """Gets latest stable version of a project, bypassing the cache"""
+        url = self.url.format(project_id)
+        try:
+            data = self.sessions.get(url).json()
+        except:
+            raise ReleaseMonitoringException(
+                "Failed to do a request to release-monitoring.org website"
+            )
+        try:
+            stable_versions = data["stable_versions"]
+        except:
+            raise ReleaseMonitoringException(
+                "Failed to get stable_versions from data received from release-monitoring.org website"
+            )
+        try:
+            return stable_versions[0]
+        except:
+            raise ReleaseMonitoringException(
+                "Failed to get first (latest) stable version"
+            )
+
+    def get_version(self, project_id):
+        """Gets latest stable version of a project, using cache if possible.
+        Raises ReleaseMonitoringException on failure (also a cached one).
+        """
+        key = str(project_id)
+        cached = self.cache.lookup(key)
+        if cached is not None:
+            (ok, value) = cached
+            if not ok:
+                raise ReleaseMonitoringException(value)
+            return value
+        try:
+            version = self.fetch_version(project_id)
+        except ReleaseMonitoringException as e:
+            self.cache.store(key, str(e), ok=False)
+            raise
+        self.cache.store(key, version)
+        return version
+
+    def prefetch(self, project_ids):
+        """Concurrently fills the cache for all given project IDs.
+        Failures are not raised here - they are cached and will be raised by
+        get_version later.
+        """
+
+        def fetch(project_id):
+            try:
+                self.get_version(project_id)
+            except ReleaseMonitoringException as e:
+                log.warning("Project {}: {}".format(project_id, e))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(fetch, set(project_ids)))
+        self.cache.save()
+
+
 class UpdateChecker:
     """Class responsible for doing dependency updates
     Currently it's working only with cfengine/buildscripts repo, as described at
     https://github.com/mendersoftware/infra/blob/master/files/buildcache/release-scripts/RELEASE_PROCESS.org#minor-dependencies-update
     """
 
-    def __init__(self, github, slack, dispatcher, username):
+    repo_name = "buildscripts"
+    upstream_name = "cfengine"
+    # how many HEAD requests to mirrors can be in flight at the same time
+    max_probe_workers = 8
+    # how far from current version find_new_version looks for new ones
+    max_version_gap = 64
+    # how long (in seconds) to remember answers from release-monitoring.org
+    monitoring_ttl = 6 * 60 * 60
+    monitoring_negative_ttl = 10 * 60
+    # how long (in seconds) to remember if a file exists on a mirror - new
+    # versions appear from time to time, but released files rarely disappear
+    probe_ttl = 30 * 24 * 60 * 60
+    probe_negative_ttl = 6 * 60 * 60
+    # how much disk space (in bytes) downloaded tarballs can take
+    tarball_cache_size = 2 * 1024 * 1024 * 1024
+
+    def __init__(
+        self,
+        github,
+        slack,
+        dispatcher,
+        username,
+        cache_dir=".",
+        monitoring_ttl=None,
+        probe_negative_ttl=None,
+    ):
         self.github = github
         self.slack = slack
         self.username = username
+        if monitoring_ttl is not None:
+            self.monitoring_ttl = monitoring_ttl
+        if probe_negative_ttl is not None:
+            self.probe_negative_ttl = probe_negative_ttl
+        self.sessions = SessionPool(pool_size=self.max_probe_workers)
+        self.monitoring = ReleaseMonitoring(
+            os.path.join(cache_dir, "release-monitoring.json"),
+            self.monitoring_ttl,
+            self.monitoring_negative_ttl,
+            self.max_probe_workers,
+        )
+        # results of HEAD requests: {url: status code}, ok=True if file exists
+        self.probes = JSONCache(
+            os.path.join(cache_dir, "url-probes.json"),
+            self.probe_ttl,
+            self.probe_negative_ttl,
+        )
+        self.tarballs = TarballCache(
+            os.path.join(cache_dir, "tarballs"),
+            self.tarball_cache_size,
+            self.sessions,
+        )
         dispatcher.register_command(
             keyword="deps",
-            callback=lambda branch: self.run(branch),
-            parameter_name="branch",
+            callback=lambda branches: self.run(branches),
+            parameter_name="branches",
             short_help="Run dependency updates",
-            long_help="Try to find new versions of dependencies on given branch and create PR with them",
+            long_help="Try to find new versions of dependencies on given branches and create PRs with them. Argument is comma-separated list of branches, NO SPACES",
         )
         dispatcher.register_command(
             keyword="depstable",
@@ -46,20 +167,37 @@ class UpdateChecker:
             short_help="Rebuild dependencies table",
             long_help="Enumerate used dependency versions and update dependency table. Argument is comma-separated list of branches, NO SPACES",
         )
+        dispatcher.register_command(
+            keyword="depsmatrix",
+            callback=lambda branches: self.run_matrix(branches),
+            parameter_name="branches",
+            short_help="Show available dependency updates",
+            long_help="Find new versions of dependencies used on given branches, looking each of them up once, and show them in one table. Argument is comma-separated list of branches, NO SPACES",
+        )
+        dispatcher.register_command(
+            keyword="depsmatrix-pr",
+            callback=lambda branches: self.run_matrix(branches, create_prs=True),
+            parameter_name="branches",
+            short_help="Run dependency updates using one table",
+            long_help="Same as depsmatrix, but also create PR for each branch, using found versions. Argument is comma-separated list of branches, NO SPACES",
+        )
 
-    def get_deps_list(self, branch="master"):
+    def get_deps_list(self, branch="master", ref=None):
         """Get list of dependencies for given branch.
-        Assumes proper branch checked out by `self.buildscripts` repo.
+        Assumes proper branch checked out by `self.buildscripts` repo,
+        unless ref is given - then files are read from that ref.
         Returns a list, like this: ["lcov", "pthreads-w32", "libgnurx"]
         """
         # TODO: get value of $EMBEDDED_DB from file
         embedded_db = "lmdb"
         if branch == "3.7.x":
             options_file = self.buildscripts.get_file(
-                "build-scripts/install-dependencies"
+                "build-scripts/install-dependencies", ref
             )
         else:
-            options_file = self.buildscripts.get_file("build-scripts/compile-options")
+            options_file = self.buildscripts.get_file(
+                "build-scripts/compile-options", ref
+            )
         options_lines = options_file.splitlines()
         if branch == "3.7.x":
             filtered_lines = (
@@ -129,41 +267,36 @@ class UpdateChecker:
         Args:
             url - URL to check (starting with http or ftp, other protocols might not work)
             sha256 - set it to True to force downloading file and returning sha256 sum
-                (otherwise, for http[s] we use HEAD request)
+                (otherwise, for http[s] we use HEAD request). Files are
+                downloaded through self.tarballs cache, so each one is
+                downloaded only once.
+                Definite results of HEAD requests (file exists, or 404/410)
+                are remembered in self.probes cache, so missing files are
+                checked again only when it expires. Errors (like 429 or 5xx)
+                are not remembered.
         Returns:
             True, False, or sha256 of a linked file
         """
         log.debug("checking URL: " + url)
+        if not sha256:
+            cached = self.probes.lookup(url)
+            if cached is not None:
+                log.debug("existence of {} found in cache".format(url))
+                return cached[0]
         try:
             if not sha256 and url.startswith("http"):
                 log.debug("testing with HEAD")
-                r = requests.head(url)
-                return r.status_code >= 200 and r.status_code < 300
+                r = self.sessions.head(url)
+                exists = r.status_code >= 200 and r.status_code < 300
+                if exists or r.status_code in (404, 410):
+                    self.probes.store(url, r.status_code, ok=exists)
+                return exists
             else:
                 log.debug("getting whole file")
-                m = hashlib.sha256()
-                with urllib.request.urlopen(url) as f:
-                    data = f.read(4096)
-                    while data:
-                        m.update(data)
-                        data = f.read(4096)
-                return m.hexdigest()
+                return self.tarballs.sha256(url)
         except:
             return False
 
-    def maybe_replace(self, string, match, old, new):
-        """replaces `old` with `new` in `string` only if it contains `match`
-        Does caseless compare by converting `string` to lowercase for comparison
-        Args:
-            string - string to work on
-            match - string to look for, MUST BE lowercase
-            old - string to replace
-            new - string to replace with
-        """
-        if match not in string.lower():
-            return string
-        return string.replace(old, new)
-
     def extract_version_from_filename(self, dep, filename):
         if dep == "openssl":
             # On different branches we use openssl from different sources
@@ -187,30 +320,118 @@ class UpdateChecker:
             separator = "."
         return (version, separator)
 
+    def get_new_url(self, old_url, old_version, new_version):
+        """Returns URL of a file with new version, given URL of old one.
+        Note that we change version on URL level, not on filename level -
+        because sometimes version might be in directory name, too. That
+        directory name might also contain only two parts of version, like
+        https://download.gnome.org/sources/libxml2/2.9/libxml2-2.9.14.tar.xz
+        """
+        new_url = old_url.replace(old_version, new_version)
+        old_dir = "/{}/".format(self.trim_version(old_version, 2))
+        new_dir = "/{}/".format(self.trim_version(new_version, 2))
+        return new_url.replace(old_dir, new_dir)
+
+    @staticmethod
+    def gallop(exists, limit):
+        """Finds highest n in range 1..limit for which exists(n) is True,
+        assuming that exists(n) is True up to some n and False after it.
+        Returns 0 if exists(1) is False.
+        First tries 1, 2, 4, 8... until it finds non-existing one, and then
+        does binary search between last existing and first non-existing,
+        so it needs O(log n) calls instead of O(n).
+        """
+        found = 0
+        step = 1
+        while step <= limit and exists(step):
+            found = step
+            step *= 2
+        missing = min(step, limit + 1)
+        while missing - found > 1:
+            middle = (found + missing) // 2
+            if exists(middle):
+                found = middle
+            else:
+                missing = middle
+        return found
+
+    def get_version_bumps(self, version, separator):
+        """Lists ways in which given version can be increased.
+        Returns a dict, where keys are names of "axes" ("patch", "minor",
+        "letter" or "suffix"), and values are tuples of (bump, limit):
+        bump(n) returns version increased n times along this axis, and limit
+        is the biggest n which makes sense.
+        For example, for version "1.2.3" with separator ".":
+        "patch" bump(2) returns "1.2.5", and "minor" bump(2) returns "1.4.0".
+        """
+        bumps = {}
+        if separator == "char":
+            if version[-1].isalpha():
+                # 1.0.2k -> 1.0.2l
+                bump = lambda n: self.increase_version(version, n, "char")
+                bumps["letter"] = (bump, ord("z") - ord(version[-1]))
+                return bumps
+            # 1.1.1 -> 1.1.1a
+            bumps["suffix"] = (lambda n: version + chr(ord("a") + n - 1), 26)
+            separator = "." if "." in version else "_"
+        components = version.split(separator)
+        if components[-1].isdigit():
+            bump = lambda n: self.increase_version(version, n, separator)
+            bumps["patch"] = (bump, self.max_version_gap)
+        if len(components) >= 3 and components[-2].isdigit():
+
+            def bump_minor(n):
+                bumped = components[:-2] + [str(int(components[-2]) + n), "0"]
+                return separator.join(bumped)
+
+            bumps["minor"] = (bump_minor, self.max_version_gap)
+        return bumps
+
     def find_new_version(self, old_url, old_version, separator):
-        """Finds new version by iteratively increasing version in URL and
-        checking if it's still possible to download a file.
+        """Finds new version by increasing version in URL and checking if it's
+        still possible to download a file.
+        Patch, minor and letter-suffix increases are probed concurrently, each
+        of them using self.gallop, so number of requests is logarithmic in
+        distance between old and new versions.
         Returns highest version for which a file exists.
         Note that if old_version is 1.2.3, and somebody released version
         1.2.5 WITHOUT releasing 1.2.4 before that, then this function will NOT
         find it
         """
-        increment = 0
-        url_result = True
-        while url_result:
-            increment += 1
-            new_version = self.increase_version(old_version, increment, separator)
-            # note that we change version on URL level, not on filename level -
-            # because sometimes version might be in directory name, too
-            new_url = old_url.replace(old_version, new_version)
-            url_result = self.checkfile(new_url)
-            # note that url_result might be True, False, or string with sha256 hash
-        # Loop ends when `increment` points to non-existing version -
-        # so we need to decrease it to point to last existing one
-        increment -= 1
-        if increment == 0:
-            return old_version
-        return self.increase_version(old_version, increment, separator)
+
+        def exists(version):
+            # note that result of checkfile might be True, False, or string
+            # with sha256 hash
+            return bool(self.checkfile(self.get_new_url(old_url, old_version, version)))
+
+        def search(bump, limit):
+            return self.gallop(lambda n: exists(bump(n)), limit)
+
+        bumps = self.get_version_bumps(old_version, separator)
+        with ThreadPoolExecutor(max_workers=self.max_probe_workers) as pool:
+            futures = {
+                axis: pool.submit(search, bump, limit)
+                for axis, (bump, limit) in bumps.items()
+            }
+            found = {axis: future.result() for axis, future in futures.items()}
+        log.debug("found version increases: {}".format(found))
+
+        if found.get("minor"):
+            bump_minor = bumps["minor"][0]
+            new_version = bump_minor(found["minor"])
+            # 1.2.9 -> 1.3.0, but there might be 1.3.1 already
+            patch_bumps = self.get_version_bumps(new_version, separator)
+            if "patch" in patch_bumps:
+                bump_patch, limit = patch_bumps["patch"]
+                increment = search(bump_patch, limit)
+                if increment > 0:
+                    new_version = bump_patch(increment)
+            return new_version
+        for axis in ["patch", "letter", "suffix"]:
+            if found.get(axis):
+                bump = bumps[axis][0]
+                return bump(found[axis])
+        return old_version
 
     def get_version_from_monitoring(self, dep):
         """Gets latest version of a dependency from release-monitoring.org site.
@@ -219,26 +440,7 @@ class UpdateChecker:
         """
         if dep not in self.monitoring_ids:
             return False
-        id = self.monitoring_ids[dep]
-        url = "https://release-monitoring.org/api/v2/versions/?project_id={}".format(id)
-        try:
-            data = requests.get(url).json()
-        except:
-            raise ReleaseMonitoringException(
-                "Failed to do a request to release-monitoring.org website"
-            )
-        try:
-            stable_versions = data["stable_versions"]
-        except:
-            raise ReleaseMonitoringException(
-                "Failed to get stable_versions from data received from release-monitoring.org website"
-            )
-        try:
-            version = stable_versions[0]
-        except:
-            raise ReleaseMonitoringException(
-                "Failed to get first (latest) stable version"
-            )
+        version = self.monitoring.get_version(self.monitoring_ids[dep])
         if dep in "openldap":
             # special case for ldap: release-monitoring takes version number
             # from git repo, which uses underscores as separators, but later we
@@ -247,60 +449,84 @@ class UpdateChecker:
         else:
             return version
 
-    def get_current_version(self, dep):
-        """Get current version of dependency dep"""
+    def get_current_url(self, dep, ref=None):
+        """Get URL of currently used source tarball of dependency dep,
+        optionally reading it from given ref instead of working tree.
+        Returns tuple (url, version, separator)
+        """
+        dist_file_path = "deps-packaging/{}/distfiles".format(dep)
+        dist_file = self.buildscripts.get_file(dist_file_path, ref).strip()
+        source_file_path = "deps-packaging/{}/source".format(dep)
+        source_file = self.buildscripts.get_file(source_file_path, ref).strip()
+        old_filename = re.sub(".* ", "", dist_file)
+        old_url = "{}{}".format(source_file, old_filename)
+        (old_version, separator) = self.extract_version_from_filename(dep, old_filename)
+        return (old_url, old_version, separator)
+
+    def get_new_version(self, dep, old_url, old_version, separator):
+        """Get latest version of dependency dep, from release-monitoring.org
+        or, if it's not there, by probing download URLs
+        """
+        new_version = self.get_version_from_monitoring(dep)
+        if not new_version:
+            log.warning(
+                "Dependency {} not found in release-monitoring.org or in data file".format(
+                    dep
+                )
+            )
+            new_version = self.find_new_version(old_url, old_version, separator)
+            self.probes.save()
+        return new_version
+
+    def get_current_version(self, dep, ref=None):
+        """Get current version of dependency dep, optionally reading it from
+        given ref instead of working tree
+        """
         # Note: this function partially duplicates next one.
         # It is done on purpose, since that one does some extra stuff.
         dist_file_path = "deps-packaging/{}/distfiles".format(dep)
-        dist_file = self.buildscripts.get_file(dist_file_path)
+        dist_file = self.buildscripts.get_file(dist_file_path, ref)
         dist_file = dist_file.strip()
         old_filename = re.sub(".* ", "", dist_file)
         (old_version, separator) = self.extract_version_from_filename(dep, old_filename)
         return old_version
 
-    def patch_spec_file(self, spec_file_path, old_version, new_version):
+    def patch_spec_file(self, transaction, spec_file_path, old_version, new_version):
         try:
-            spec_file = self.buildscripts.get_file(spec_file_path)
+            spec_file = transaction.get_file(spec_file_path)
         except:
             pass
         else:
             spec_file = spec_file.replace(old_version, new_version)
-            self.buildscripts.put_file(spec_file_path, spec_file)
+            transaction.put_file(spec_file_path, spec_file)
 
-    def update_single_dep(self, dep):
+    def update_single_dep(self, dep, new_version=None):
         """Check if new version of dependency dep was released and create
-        commit updating it in *.spec, dist, source, and README.md files
+        commit updating it in *.spec, dist, source, and README.md files.
+        If new_version is given, it's used instead of looking it up.
         """
         # Note: this function partially duplicates above one.
         # It is done on purpose, since it will need several other variables
         # afterwards: dist_file_path, old_filename, and separator.
         log.info("Checking new version of {}".format(dep))
+        # all changed files are staged and committed at once
+        transaction = self.buildscripts.transaction()
         dist_file_path = "deps-packaging/{}/distfiles".format(dep)
-        dist_file = self.buildscripts.get_file(dist_file_path)
+        dist_file = transaction.get_file(dist_file_path)
         dist_file = dist_file.strip()
         source_file_path = "deps-packaging/{}/source".format(dep)
-        source_file = self.buildscripts.get_file(source_file_path)
+        source_file = transaction.get_file(source_file_path)
         source_file = source_file.strip()
         old_filename = re.sub(".* ", "", dist_file)
         old_url = "{}{}".format(source_file, old_filename)
         (old_version, separator) = self.extract_version_from_filename(dep, old_filename)
-        new_version = self.get_version_from_monitoring(dep)
-        if not new_version:
-            log.warning(
-                "Dependency {} not found in release-monitoring.org or in data file".format(
-                    dep
-                )
-            )
-            new_version = self.find_new_version(old_url, old_version, separator)
+        if new_version is None:
+            new_version = self.get_new_version(dep, old_url, old_version, separator)
         if new_version == old_version:
             # no update needed
             return False
         new_filename = old_filename.replace(old_version, new_version)
-        new_url = old_url.replace(old_version, new_version)
-        if dep == "libxml2":
-            new_url = new_url.replace(
-                self.trim_version(old_version, 2), self.trim_version(new_version, 2)
-            )
+        new_url = self.get_new_url(old_url, old_version, new_version)
         sha256sum = self.checkfile(new_url, True)
         if not sha256sum:
             message = "Update {} from {} to {} FAILED to download {}".format(
@@ -312,181 +538,81 @@ class UpdateChecker:
         message = "Updated {} from {} to {}".format(dep, old_version, new_version)
         log.info(message)
         dist_file = "{}  {}".format(sha256sum, new_filename)
-        self.buildscripts.put_file(dist_file_path, dist_file + "\n")
-        source_file = source_file.replace(old_version, new_version)
-        if dep == "libxml2":
-            source_file = source_file.replace(
-                self.trim_version(old_version, 2), self.trim_version(new_version, 2)
-            )
-        self.buildscripts.put_file(source_file_path, source_file + "\n")
-        self.readme_lines = [
-            self.maybe_replace(
-                x, "* [{}](".format(dep.replace("-hub", "")), old_version, new_version
-            )
-            for x in self.readme_lines
-        ]
-        readme_file = "\n".join(self.readme_lines)
-        self.buildscripts.put_file(self.readme_file_path, readme_file)
+        transaction.put_file(dist_file_path, dist_file + "\n")
+        # keep source directory in sync with new_url
+        source_file = self.get_new_url(source_file, old_version, new_version)
+        transaction.put_file(source_file_path, source_file + "\n")
+        self.readme.replace_version(dep.replace("-hub", ""), old_version, new_version)
+        transaction.put_file(self.readme_file_path, str(self.readme))
         self.patch_spec_file(
+            transaction,
             "deps-packaging/{}/cfbuild-{}.spec".format(dep, dep),
             old_version,
             new_version,
         )
         self.patch_spec_file(
+            transaction,
             "deps-packaging/{}/cfbuild-{}-aix.spec".format(dep, dep),
             old_version,
             new_version,
         )
-        self.buildscripts.commit(message)
+        transaction.commit(message)
         return message
 
-    def collect_deps(self, branch):
+    def collect_deps(self, branch, ref=None):
         """List used dependencies for a branch, returns a dict like this:
         {"dep1": "version", "dep2": "version",...}
+        If ref is given, files are read from it, otherwise - from working tree.
         """
         deps_versions = {}
-        deps_list = self.get_deps_list(branch)
+        deps_list = self.get_deps_list(branch, ref)
         for dep in deps_list:
-            deps_versions[dep] = self.get_current_version(dep)
+            deps_versions[dep] = self.get_current_version(dep, ref)
         return deps_versions
 
-    def update_deps_version(self, branches):
-        # prepare repo
-        repo_name = "buildscripts"
-        upstream_name = "cfengine"
-        local_path = "../" + repo_name
-        self.buildscripts = GitRepo(
-            local_path, repo_name, upstream_name, self.username, "master"
+    def get_repo(self, branches):
+        """Prepares buildscripts repo, fetching given branches at once.
+        Nothing is checked out in it - use worktrees or read files from
+        upstream/<branch> refs.
+        """
+        return GitRepo(
+            "../" + self.repo_name,
+            self.repo_name,
+            self.upstream_name,
+            self.username,
+            fetch_branches=branches,
         )
 
+    def update_deps_version(self, branches):
+        # prepare repo, fetching all branches at once, together with master
         branches = branches.split(",")
+        self.buildscripts = self.get_repo(branches + ["master"])
 
-        # fetch versions from all branches
+        # fetch versions from all branches, reading files directly from
+        # fetched refs instead of checking out each branch
         deps_table = {}
         # deps_table is a 2d dict: deps_table[dep][branch]=version
-        branch_column_widths = {}
         for branch in branches:
-            branch_column_widths[branch] = len(branch)
-            self.buildscripts.checkout(branch)
-            self.buildscripts.run_command("pull")
-            deps_versions = self.collect_deps(branch)
+            deps_versions = self.collect_deps(branch, ref="upstream/" + branch)
             # deps_versions is a dict: deps_versions[dep]=version
             for dep in deps_versions:
-                if not dep in deps_table:
-                    deps_table[dep] = collections.defaultdict(lambda: "-")
-                deps_table[dep][branch] = deps_versions[dep]
-                branch_column_widths[branch] = max(
-                    branch_column_widths[branch], len(deps_versions[dep])
-                )
+                deps_table.setdefault(dep, {})[branch] = deps_versions[dep]
 
         # patch the readme
-        self.buildscripts.checkout("master")
         self.readme_file_path = "README.md"
-        readme_file = self.buildscripts.get_file(self.readme_file_path)
-        readme_lines = readme_file.split("\n")
-        has_notes = False  # flag to say that we're in a table that has "Notes" column
-        in_hub = False  # flag that we're in Hub section
-        for i, line in enumerate(readme_lines):
-            if " Hub " in line:
-                in_hub = True
-            if not line.startswith("| "):
-                continue
-            if line.startswith("| CFEngine version "):
-                has_notes = "Notes" in line
-                # Desired output row: ['CFEngine version', branches..., 'Notes']
-                # Also note that list addition is concatenation: [1] + [2] == [1, 2]
-                row = (
-                    ["CFEngine version"]
-                    + [branch for branch in branches]
-                    + (["Notes"] if has_notes else [])
-                )
-                # Width of source columns
-                column_widths = [len(x) for x in line.split("|")]
-                # Note that first and last column widths are zero, since line
-                # begins and ends with '|'. We're actually interested in widths
-                # of first column (with words "CFEngine version" in it) and,
-                # possibly, last ("Notes", which is now second-to-last).
-                # Between them are branch column widths, calculated earlier.
-                # Also we substract 2 to remove column "padding".
-                column_widths = (
-                    [column_widths[1] - 2]
-                    + [  # "CFEngine version"
-                        branch_column_widths[branch] for branch in branches
-                    ]
-                    + (
-                        [column_widths[-2] - 2] if has_notes else []
-                    )  # "Notes", if exists
-                )
-                line = (
-                    "| "
-                    + (
-                        " | ".join(
-                            (val.ljust(width) for val, width in zip(row, column_widths))
-                        )
-                    )
-                    + " |"
-                )
-            elif line.startswith("| --"):
-                line = (
-                    "| " + (" | ".join(("-" * width for width in column_widths))) + " |"
-                )
-            else:
-                # Sample line:
-                # | [PHP](http://php.net/) ...
-                # For it, in regexp below,
-                # \[([a-z0-9-]*)\] will match [PHP]
-                # \((.*?)\) will match (http://php.net/)
-                match = re.match(
-                    "\| \[([a-z0-9-]*)\]\((.*?)\) ", line, flags=re.IGNORECASE
-                )
-                if match:
-                    dep_title = match.group(1)
-                    dep = dep_title.lower()
-                    url = match.group(2)
-                else:
-                    log.warn("didn't find dep in line [%s]", line)
-                    continue
-                if dep not in deps_table:
-                    log.warn(
-                        "unknown dependency in README: [%s] line [%s], will be EMPTY",
-                        dep,
-                        line,
-                    )
-                    deps_table[dep] = collections.defaultdict(lambda: "-")
-                if has_notes:
-                    note = re.search("\| ([^|]*) \|$", line)
-                    if not note:
-                        log.warn("didn't find note in line [%s]", line)
-                        note = ""
-                    else:
-                        note = note.group(1)
-                if in_hub:
-                    dep = re.sub("-hub$", "", dep)
-                row = (
-                    ["[%s](%s)" % (dep_title, url)]
-                    + [deps_table[dep][branch] for branch in branches]
-                    + ([note] if has_notes else [])
-                )
-                line = (
-                    "| "
-                    + (
-                        " | ".join(
-                            (val.ljust(width) for val, width in zip(row, column_widths))
-                        )
-                    )
-                    + " |"
-                )
-            readme_lines[i] = line
+        readme = DepsReadme(
+            self.buildscripts.get_file(self.readme_file_path, "upstream/master")
+        )
+        readme.update_tables(branches, deps_table)
 
         timestamp = re.sub("[^0-9-]", "_", str(datetime.datetime.today()))
         new_branchname = "deptables-{}".format(timestamp)
-        self.buildscripts.checkout(new_branchname, new=True)
-        readme_file = "\n".join(readme_lines)
-        self.buildscripts.put_file(self.readme_file_path, readme_file)
-        self.buildscripts.commit("Update dependency tables")
-        self.buildscripts.push(new_branchname)
+        with self.buildscripts.worktree("upstream/master", new_branchname) as worktree:
+            worktree.put_file(self.readme_file_path, str(readme))
+            worktree.commit("Update dependency tables")
+            worktree.push(new_branchname)
         pr_text = self.github.create_pr(
-            target_repo="{}/{}".format(upstream_name, repo_name),
+            target_repo="{}/{}".format(self.upstream_name, self.repo_name),
             target_branch="master",
             source_user=self.username,
             source_branch=new_branchname,
@@ -495,40 +621,181 @@ class UpdateChecker:
         )
         self.slack.reply("Dependency tables:\n{}".format(pr_text), True)
 
-    def run(self, branch):
-        """Run the dependency update for a branch, creating PR in the end"""
-        self.slack.reply("Running dependency updates for " + branch)
-        # prepare repo
-        repo_name = "buildscripts"
-        upstream_name = "cfengine"
-        local_path = "../" + repo_name
-        self.buildscripts = GitRepo(
-            local_path, repo_name, upstream_name, self.username, branch
+    def get_updates_matrix(self, branches):
+        """Finds new versions of dependencies of all branches, looking up
+        each (dependency, current URL) pair only once, concurrently.
+        Returns a 2d dict: matrix[dep][branch]=(old_version, new_version)
+        """
+        current = {}
+        # current is a 2d dict: current[dep][branch]=(url, version, separator)
+        self.monitoring_ids = {}
+        for branch in branches:
+            ref = "upstream/" + branch
+            # branches normally agree on ids, so just merge them
+            self.monitoring_ids.update(
+                json.loads(
+                    self.buildscripts.get_file(
+                        "deps-packaging/release-monitoring.json", ref
+                    )
+                )
+            )
+            for dep in self.get_deps_list(branch, ref):
+                current.setdefault(dep, {})[branch] = self.get_current_url(dep, ref)
+        self.monitoring.prefetch(
+            self.monitoring_ids[dep] for dep in current if dep in self.monitoring_ids
+        )
+        lookups = {
+            (dep, url): (url, version, separator)
+            for dep in current
+            for (url, version, separator) in current[dep].values()
+        }
+        log.info(
+            "Looking up {} versions of {} dependencies on {} branches".format(
+                len(lookups), len(current), len(branches)
+            )
+        )
+        with ThreadPoolExecutor(max_workers=self.max_probe_workers) as pool:
+            futures = {
+                key: pool.submit(self.get_new_version, key[0], *args)
+                for key, args in lookups.items()
+            }
+            new_versions = {key: future.result() for key, future in futures.items()}
+        return {
+            dep: {
+                branch: (version, new_versions[(dep, url)])
+                for branch, (url, version, separator) in current[dep].items()
+            }
+            for dep in current
+        }
+
+    def format_matrix(self, branches, matrix):
+        """Formats dependencies which have updates on any of branches as a
+        table, one column per branch
+        """
+        rows = [["Dependency"] + branches]
+        for dep in sorted(matrix):
+            cells = []
+            for branch in branches:
+                if branch not in matrix[dep]:
+                    cells.append("-")
+                    continue
+                (old_version, new_version) = matrix[dep][branch]
+                if new_version == old_version:
+                    cells.append(old_version)
+                else:
+                    cells.append("{} -> {}".format(old_version, new_version))
+            if any("->" in cell for cell in cells):
+                rows.append([dep] + cells)
+        if len(rows) == 1:
+            return None
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            " | ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+            for row in rows
         )
+
+    def run_matrix(self, branches, create_prs=False):
+        """Show new versions of dependencies of comma-separated list of
+        branches in one table, optionally creating PR for each branch
+        """
+        branches = branches.split(",")
+        repo = self.get_repo(branches)
+        self.buildscripts = repo
+        matrix = self.get_updates_matrix(branches)
+        table = self.format_matrix(branches, matrix)
+        if table is None:
+            self.slack.reply(
+                "Dependencies checked on {}, nothing to update".format(
+                    ", ".join(branches)
+                )
+            )
+            return
+        self.slack.reply("Available dependency updates:\n```\n{}\n```".format(table))
+        if not create_prs:
+            return
+        updates = {
+            branch: {
+                dep: matrix[dep][branch][1]
+                for dep in matrix
+                if branch in matrix[dep]
+                and matrix[dep][branch][0] != matrix[dep][branch][1]
+            }
+            for branch in branches
+        }
+        with ThreadPoolExecutor(max_workers=len(branches)) as pool:
+            futures = [
+                pool.submit(copy(self).update_branch, repo, branch, updates[branch])
+                for branch in branches
+                if updates[branch]
+            ]
+            for future in futures:
+                future.result()
+
+    def run(self, branches):
+        """Run the dependency update for comma-separated list of branches,
+        creating PR for each of them in the end. Branches are updated in
+        parallel, each one in a separate worktree of buildscripts repo.
+        """
+        branches = branches.split(",")
+        repo = self.get_repo(branches)
+        if len(branches) == 1:
+            self.update_branch(repo, branches[0])
+            return
+        with ThreadPoolExecutor(max_workers=len(branches)) as pool:
+            # each branch is updated by a copy of self, since update_branch
+            # keeps its state in attributes; caches are shared between copies
+            futures = [
+                pool.submit(copy(self).update_branch, repo, branch)
+                for branch in branches
+            ]
+            for future in futures:
+                future.result()
+
+    def update_branch(self, repo, branch, updates=None):
+        """Run the dependency update for a branch, creating PR in the end.
+        If updates are given (as {dep: new_version}), only these dependencies
+        are updated, without looking up their versions again.
+        """
+        self.slack.reply("Running dependency updates for " + branch)
         timestamp = re.sub("[^0-9-]", "_", str(datetime.datetime.today()))
         new_branchname = "{}-deps-{}".format(branch, timestamp)
-        self.buildscripts.checkout(new_branchname, new=True)
+        with repo.worktree("upstream/" + branch, new_branchname) as worktree:
+            self.buildscripts = worktree
+            self.update_deps_in_worktree(branch, new_branchname, updates)
+
+    def update_deps_in_worktree(self, branch, new_branchname, updates=None):
+        """Commits dependency updates to new_branchname, which is checked out
+        in self.buildscripts worktree, pushes it and creates PR
+        """
         self.readme_file_path = "deps-packaging/README.md"
-        readme_file = self.buildscripts.get_file(self.readme_file_path)
-        self.readme_lines = readme_file.split("\n")
+        self.readme = DepsReadme(self.buildscripts.get_file(self.readme_file_path))
         self.monitoring_file_path = "deps-packaging/release-monitoring.json"
         self.monitoring_ids = json.loads(
             self.buildscripts.get_file(self.monitoring_file_path)
         )
         updates_summary = []
         only_deps = self.get_deps_list(branch)
+        if updates is not None:
+            only_deps = [dep for dep in only_deps if dep in updates]
+        self.monitoring.prefetch(
+            self.monitoring_ids[dep] for dep in only_deps if dep in self.monitoring_ids
+        )
         for dep in only_deps:
-            single_result = self.update_single_dep(dep)
+            single_result = self.update_single_dep(
+                dep, updates[dep] if updates is not None else None
+            )
             if single_result:
                 updates_summary.append(single_result)
                 self.slack.reply(single_result)
         if len(updates_summary) == 0:
-            self.slack.reply("Dependency checked, nothing to update")
+            self.slack.reply(
+                "Dependency checked on {}, nothing to update".format(branch)
+            )
             return
         self.buildscripts.push(new_branchname)
         updates_summary = "\n".join(updates_summary)
         pr_text = self.github.create_pr(
-            target_repo="{}/{}".format(upstream_name, repo_name),
+            target_repo="{}/{}".format(self.upstream_name, self.repo_name),
             target_branch=branch,
             source_user=self.username,
             source_branch=new_branchname,
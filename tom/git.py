@@ -1,6 +1,15 @@
 import os
+import re
+import time
+import shutil
+import fcntl
+import tempfile
+import contextlib
 import logging as log
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tom.gitbackend import get_backend
 
 
 class GitException(Exception):
@@ -15,9 +24,24 @@ class WrongArgumentsException(GitException):
     pass
 
 
+class RepoPreparationException(GitException):
+    """Exception that is risen when some repos of a RepoSet failed to prepare"""
+
+    pass
+
+
 class GitRepo:
     """Class responsible for working with locally checked-out repository"""
 
+    # how many submodules can be fetched at the same time
+    submodule_jobs = 4
+    # how to read refs and files: "cli" (run `git`) or "dulwich" (in-process,
+    # if dulwich library is installed); changes are always done by `git`
+    default_backend = "cli"
+    # worktrees without a lease are removed only when they are older than
+    # this (in seconds), since lease is written right after creating them
+    worktree_grace_period = 3600
+
     def __init__(
         self,
         dirname,
@@ -26,6 +50,12 @@ class GitRepo:
         my_name,
         checkout_branch=None,
         checkout_tag=None,
+        clone_filter=None,
+        reference=None,
+        fetch_branches=(),
+        fetch_tags=(),
+        shallow_submodules=False,
+        backend=None,
     ):
         """Clones a remore repo to a directory (or freshens it if it's already
         checked out), configures it and optionally checks out a requested branch
@@ -40,16 +70,96 @@ class GitRepo:
             checkout_branch - optional name of branch to checkout. If not provided,
                 a branch from previous work might be left checked out
             checkout_tag - same for tag.
+            clone_filter - optional filter for partial clone, like 'blob:none'
+                (history is cloned without file contents, which are fetched
+                later, only when needed). Used only when cloning a new repo.
+            reference - optional path to another local clone, whose objects
+                will be used instead of downloading them again (via git
+                alternates). Note that the other clone must not be deleted
+                or garbage-collected while this one is used.
+            fetch_branches, fetch_tags - names of other branches and tags
+                which will be needed later. They are fetched together with
+                checkout_branch/checkout_tag using one `git fetch`, and later
+                checkout() of them doesn't fetch again.
+            shallow_submodules - set to True to fetch only needed commits of
+                submodules, without their history
+            backend - name of backend for reading refs and files, see
+                default_backend
         """
-        self.dirname = dirname
-        self.repo_name = repo_name
-        self.username = my_name  # TODO: this should be github username of current user
+        # TODO: my_name should be github username of current user
+        self.init_attributes(
+            dirname,
+            repo_name,
+            my_name,
+            shallow_submodules,
+            os.path.join(dirname, ".git", "tom.lock"),
+        )
 
         upstream_url = "git@github.com:{}/{}.git".format(upstream_name, repo_name)
         origin_url = "git@github.com:{}/{}.git".format(my_name, repo_name)
 
         if not os.path.exists(dirname):
-            self.run_command("clone", "--no-checkout", origin_url, dirname)
+            clone_command = ["clone", "--no-checkout"]
+            if clone_filter is not None:
+                clone_command.append("--filter=" + clone_filter)
+            if reference is not None:
+                clone_command.extend(["--reference-if-able", reference])
+            self.run_command(*clone_command, origin_url, dirname)
+        self.backend = get_backend(backend or self.default_backend, self)
+        with self.lock():
+            self.configure(upstream_url, reference)
+            branches = list(fetch_branches)
+            if checkout_branch is not None:
+                branches.append(checkout_branch)
+            tags = list(fetch_tags)
+            if checkout_tag is not None:
+                tags.append(checkout_tag)
+            self.fetch(branches=branches, tags=tags)
+        if checkout_branch is not None:
+            self.checkout(checkout_branch)
+        if checkout_tag is not None:
+            self.checkout(checkout_tag, tag=True)
+
+    def init_attributes(
+        self, dirname, repo_name, username, shallow_submodules, lock_path
+    ):
+        """Sets attributes shared by GitRepo and Worktree"""
+        self.dirname = dirname
+        self.repo_name = repo_name
+        self.username = username
+        self.shallow_submodules = shallow_submodules
+        self.backend = None
+        # refs fetched by this object: {(remote, name): local ref}
+        self.fetched_refs = {}
+        self.lock_path = lock_path
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Context manager which makes sure that only one thread or process
+        changes shared parts of repo (config, remote refs, worktrees list)
+        at a time. Can be nested.
+        """
+        with self._lock:
+            if self._lock_depth == 0:
+                self._lock_file = open(self.lock_path, "w")
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def configure(self, upstream_url, reference=None):
+        """Sets up remotes (and alternates) of a cloned repo"""
+        if reference is not None:
+            self.add_alternate(reference)
         upstream_add_command_result = self.run_command(
             "remote", "add", "upstream", upstream_url, check=False
         )
@@ -57,10 +167,19 @@ class GitRepo:
             # Assume that we failed to add remote called 'upstream' because it was
             # already added. In this case, we should succeed in setting its url.
             self.run_command("remote", "set-url", "upstream", upstream_url)
-        if checkout_branch is not None:
-            self.checkout(checkout_branch)
-        if checkout_tag is not None:
-            self.checkout(checkout_tag, tag=True)
+        partial_clone_filter = self.run_command(
+            "config",
+            "remote.origin.partialclonefilter",
+            capture_output=True,
+            check=False,
+        ).stdout.strip()
+        if partial_clone_filter:
+            # we fetch from upstream, so it must also be a promisor remote -
+            # otherwise missing objects can't be fetched from it later
+            self.run_command("config", "remote.upstream.promisor", "true")
+            self.run_command(
+                "config", "remote.upstream.partialclonefilter", partial_clone_filter
+            )
 
     def run_command(self, *command, **kwargs):
         """Runs a git command against git repo.
@@ -94,6 +213,48 @@ class GitRepo:
         log.debug("running command: {}".format(" ".join(git_command)))
         return subprocess.run(git_command, **kwargs)
 
+    def add_alternate(self, reference):
+        """Makes objects of another local clone available to this one"""
+        objects_dir = os.path.join(os.path.abspath(reference), ".git", "objects")
+        if not os.path.isdir(objects_dir):
+            # bare repo
+            objects_dir = os.path.join(os.path.abspath(reference), "objects")
+        alternates_path = self.run_command(
+            "rev-parse", "--git-path", "objects/info/alternates", capture_output=True
+        ).stdout.strip()
+        alternates_path = os.path.join(self.dirname, alternates_path)
+        alternates = []
+        if os.path.exists(alternates_path):
+            with open(alternates_path) as f:
+                alternates = f.read().splitlines()
+        if objects_dir not in alternates:
+            with open(alternates_path, "a") as f:
+                f.write(objects_dir + "\n")
+
+    def fetch(self, branches=(), tags=(), remote="upstream"):
+        """Fetches several branches and tags from remote with one `git fetch`.
+        Branches are stored as remote-tracking branches (like upstream/master),
+        so they can be read with get_file(path, ref="upstream/master")
+        without checking them out.
+        """
+        branches = list(dict.fromkeys(branches))
+        tags = list(dict.fromkeys(tags))
+        local_refs = {}
+        for branch in branches:
+            local_refs[branch] = "refs/remotes/{}/{}".format(remote, branch)
+        for tag in tags:
+            local_refs[tag] = "refs/tags/{}".format(tag)
+        if not local_refs:
+            return
+        refspecs = ["+refs/heads/{}:{}".format(b, local_refs[b]) for b in branches]
+        refspecs += ["+refs/tags/{}:{}".format(t, local_refs[t]) for t in tags]
+        with self.lock():
+            self.run_command("fetch", remote, *refspecs)
+        for name, local_ref in local_refs.items():
+            self.fetched_refs[(remote, name)] = local_ref
+        # make sure new refs are visible to `git cat-file`
+        self.close()
+
     def checkout(self, branch=None, tag=None, remote="upstream", new=False):
         """Checkout given branch or tag, optionally creating branch.
         Note that it's an error to create-and-checkout branch which already exists.
@@ -116,17 +277,81 @@ class GitRepo:
             # just create new branch
             self.run_command("checkout", "-b", branch)
         else:
-            # first, ensure that we're aware of target ref
-            self.run_command("fetch", remote, ref)
+            # first, ensure that we're aware of target ref (unless it was
+            # already fetched by this object)
+            target = self.fetched_refs.get((remote, ref))
+            if target is None:
+                with self.lock():
+                    self.run_command("fetch", remote, ref)
+                target = "FETCH_HEAD"
             # switch to the branch
             if branch:
                 self.run_command("checkout", branch)
             # ensure we're on the tip of ref
-            self.run_command("reset", "--hard", "FETCH_HEAD")
-        self.run_command("submodule", "update", "--init")
+            self.run_command("reset", "--hard", target)
+            self.close()
+        self.update_submodules()
 
-    def get_file(self, path):
-        """Returns contents of a file as a single string"""
+    def get_stale_submodules(self):
+        """Returns paths of submodules which are not initialized, or whose
+        checked out commit differs from the one recorded in HEAD (for
+        example, because previous update failed half-way)
+        """
+        output = self.run_command(
+            "submodule", "status", capture_output=True
+        ).stdout.rstrip("\n")
+        paths = []
+        for line in output.split("\n") if output else []:
+            # "<state><sha> <path> (<describe>)", where state is " " for
+            # up to date submodule, "-" for not initialized, "+" for
+            # different commit and "U" for merge conflicts
+            if line[0] == " ":
+                continue
+            path = line[1:].split(" ", 1)[1]
+            paths.append(re.sub(" \\([^)]*\\)$", "", path))
+        return paths
+
+    def update_submodules(self):
+        """Updates submodules which are not initialized or not at commits
+        recorded in HEAD
+        """
+        paths = self.get_stale_submodules()
+        if not paths:
+            log.debug("submodules of {} are up to date".format(self.dirname))
+            return
+        command = ["submodule", "update", "--init", "--jobs", str(self.submodule_jobs)]
+        if self.shallow_submodules:
+            command.extend(["--depth", "1"])
+        self.run_command(*command, "--", *paths)
+
+    def read_object(self, name):
+        """Returns contents of a git object (like 'master:README.md') as bytes.
+        Raises FileNotFoundError if object doesn't exist.
+        """
+        return self.backend.read_object(name)
+
+    def rev_parse(self, ref):
+        """Returns SHA of object named by ref, or None if it doesn't exist"""
+        return self.backend.rev_parse(ref)
+
+    def describe(self, ref="HEAD"):
+        """Returns name of the closest annotated tag reachable from ref"""
+        return self.backend.describe(ref)
+
+    def close(self):
+        """Frees resources used for reading (like `git cat-file` process).
+        Must be called after refs are changed, to make changes visible.
+        """
+        if self.backend is not None:
+            self.backend.close()
+
+    def get_file(self, path, ref=None):
+        """Returns contents of a file as a single string.
+        If ref (branch, tag or commit) is given, file is read from it instead
+        of working tree, without checking it out.
+        """
+        if ref is not None:
+            return self.read_object("{}:{}".format(ref, path)).decode("utf-8")
         with open(self.dirname + "/" + path) as f:
             return f.read()
 
@@ -141,6 +366,15 @@ class GitRepo:
         """Creates commit with message"""
         self.run_command("commit", "-m", message, "--allow-empty")
 
+    def transaction(self, branch=None, start_point=None):
+        """Returns Transaction which collects changes to files in memory and
+        commits them at once. By default, changes are committed to working
+        tree of this repo. If branch is given, commits are created directly
+        on it (optionally starting from start_point), without touching
+        working tree or index - so branch doesn't need to be checked out.
+        """
+        return Transaction(self, branch, start_point)
+
     def push(self, ref=None, remote="origin", upstream=True):
         """Pushes local branch or tag to remote repo, optionally also setting it as upstream"""
         cmd = ["push"]
@@ -150,4 +384,291 @@ class GitRepo:
         if ref is not None:
             cmd.append(ref)
 
-        self.run_command(*cmd)
+        with self.lock():
+            self.run_command(*cmd)
+
+    def worktrees_root(self):
+        return self.dirname.rstrip("/") + ".worktrees"
+
+    @contextlib.contextmanager
+    def worktree(self, ref, branch=None):
+        """Context manager which creates a separate working tree with ref
+        checked out, and optionally a new branch created at it. Worktree
+        shares objects and refs with this repo, so several worktrees (in one
+        or several processes) can work on different branches at the same
+        time without touching working tree of this repo.
+        Worktree is leased to the current process and removed on exit from
+        `with` block. Worktrees left by crashed processes are cleaned up next
+        time a worktree is created.
+        Example:
+            with repo.worktree("upstream/3.21.x", "3.21.x-fixes") as worktree:
+                worktree.put_file("README.md", "Hello")
+                worktree.commit("Say hello")
+        """
+        self.cleanup_worktrees()
+        root = self.worktrees_root()
+        os.makedirs(root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix="{}-".format(os.getpid()), dir=root)
+        # write lease atomically, so that other processes never see it empty
+        lease_path = path + ".lease"
+        tmp_path = "{}.{}.tmp".format(lease_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(str(os.getpid()))
+        os.replace(tmp_path, lease_path)
+        with self.lock():
+            if branch is None:
+                self.run_command("worktree", "add", "--detach", path, ref)
+            else:
+                self.run_command("worktree", "add", "-b", branch, path, ref)
+        worktree = Worktree(self, path)
+        try:
+            worktree.update_submodules()
+            yield worktree
+        finally:
+            worktree.close()
+            self.remove_worktree(path)
+
+    def remove_worktree(self, path):
+        with self.lock():
+            self.run_command("worktree", "remove", "--force", path, check=False)
+            self.run_command("worktree", "prune")
+        # directory might be not registered as worktree, if process crashed
+        # before `git worktree add`
+        shutil.rmtree(path, ignore_errors=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + ".lease")
+
+    def cleanup_worktrees(self):
+        """Removes worktrees leased to processes which don't exist anymore,
+        and ones without a lease (left by processes which crashed right after
+        creating them) older than worktree_grace_period
+        """
+        root = self.worktrees_root()
+        if not os.path.isdir(root):
+            return
+        names = os.listdir(root)
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith(".lease") or name + ".lease" in names:
+                continue
+            try:
+                age = time.time() - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age > self.worktree_grace_period:
+                log.info("Removing unleased worktree {}".format(path))
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                else:
+                    self.remove_worktree(path)
+        for name in names:
+            if not name.endswith(".lease"):
+                continue
+            lease_path = os.path.join(root, name)
+            try:
+                with open(lease_path) as f:
+                    pid = f.read().strip()
+            except FileNotFoundError:
+                continue  # removed by another process meanwhile
+            # empty or garbled lease (process crashed while writing it) is
+            # stale too; note that os.kill(0, 0) would signal our own group
+            if pid.isdigit() and int(pid) > 0:
+                try:
+                    os.kill(int(pid), 0)
+                    continue  # process is still running
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue  # process exists, but belongs to another user
+            path = lease_path[: -len(".lease")]
+            log.info("Removing stale worktree {}".format(path))
+            self.remove_worktree(path)
+
+
+class Transaction:
+    """Class responsible for collecting changes to files of a GitRepo and
+    committing them with as few git processes as possible.
+    Nothing is written to disk until commit(), so if something fails midway,
+    repo is left untouched. Uncommitted changes are simply dropped.
+    Example:
+        transaction = repo.transaction()
+        transaction.put_file("README.md", "Hello")
+        transaction.put_file("LICENSE", "Public domain")
+        transaction.commit("Say hello")  # one `git add` and one `git commit`
+    """
+
+    default_mode = "100644"
+
+    def __init__(self, repo, branch=None, start_point=None):
+        self.repo = repo
+        self.branch = branch
+        self.start_point = start_point
+        self.files = {}
+        self.head = None
+        if branch is not None:
+            self.head = self.rev_parse(start_point or "refs/heads/" + branch)
+
+    def rev_parse(self, ref):
+        sha = self.repo.rev_parse(ref + "^{commit}")
+        if sha is None:
+            raise GitException("{} is not a commit".format(ref))
+        return sha
+
+    def get_file(self, path):
+        """Returns contents of a file, including uncommitted changes"""
+        if path in self.files:
+            return self.files[path]
+        return self.repo.get_file(path, self.head)
+
+    def put_file(self, path, data):
+        """Overwrites file with data (in memory, until commit)"""
+        self.files[path] = data
+
+    def commit(self, message):
+        """Commits all collected changes with message"""
+        if self.branch is None:
+            self.commit_to_worktree(message)
+        else:
+            self.commit_to_branch(message)
+        self.files = {}
+
+    def commit_to_worktree(self, message):
+        """Writes files and stages them with single `git add`"""
+        for path, data in self.files.items():
+            with open(os.path.join(self.repo.dirname, path), "w") as f:
+                f.write(data)
+        if self.files:
+            self.repo.run_command("add", "--", *self.files)
+        self.repo.commit(message)
+
+    def commit_to_branch(self, message):
+        """Builds commit with plumbing commands, using temporary index:
+        hash-object (all files at once), read-tree, update-index, write-tree,
+        commit-tree, and update-ref
+        """
+        run = self.repo.run_command
+        with tempfile.TemporaryDirectory() as tmp:
+            blob_paths = []
+            for i, data in enumerate(self.files.values()):
+                blob_paths.append(os.path.join(tmp, str(i)))
+                with open(blob_paths[-1], "w") as f:
+                    f.write(data)
+            blobs = []
+            if blob_paths:
+                blobs = run(
+                    "hash-object",
+                    "-w",
+                    "--stdin-paths",
+                    input="\n".join(blob_paths) + "\n",
+                    capture_output=True,
+                ).stdout.split()
+            # keep modes of existing files (like executable bit)
+            modes = {}
+            if self.files:
+                ls_tree = run(
+                    "ls-tree", "-z", self.head, "--", *self.files, capture_output=True
+                ).stdout
+                for entry in ls_tree.split("\0"):
+                    if entry:
+                        (info, path) = entry.split("\t", 1)
+                        modes[path] = info.split()[0]
+            index_info = "".join(
+                "{} {}\t{}\n".format(modes.get(path, self.default_mode), blob, path)
+                for path, blob in zip(self.files, blobs)
+            )
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, "index"))
+            run("read-tree", self.head, env=env)
+            run("update-index", "--index-info", input=index_info, env=env)
+            tree = run("write-tree", env=env, capture_output=True).stdout.strip()
+        commit = run(
+            "commit-tree", tree, "-p", self.head, "-m", message, capture_output=True
+        ).stdout.strip()
+        ref = "refs/heads/" + self.branch
+        with self.repo.lock():
+            if self.start_point is not None:
+                run("update-ref", ref, commit)
+                self.start_point = None
+            else:
+                # fail if branch was changed by someone else meanwhile
+                run("update-ref", ref, commit, self.head)
+        self.head = commit
+
+
+class Worktree(GitRepo):
+    """Class responsible for working with a separate working tree of a
+    GitRepo, created by GitRepo.worktree()
+    """
+
+    def __init__(self, repo, dirname):
+        # changes to shared parts of repo are guarded by the same lock file
+        self.init_attributes(
+            dirname,
+            repo.repo_name,
+            repo.username,
+            repo.shallow_submodules,
+            repo.lock_path,
+        )
+        self.fetched_refs = dict(repo.fetched_refs)
+        self.backend = get_backend(repo.backend.name, self)
+
+
+class RepoSet:
+    """Class responsible for preparing several repos at once.
+    Cloning, fetching, resetting and updating submodules is done by GitRepo
+    constructors, and RepoSet runs them concurrently - so preparing all repos
+    takes roughly as long as preparing the slowest one.
+    """
+
+    # how many repos can be prepared at the same time
+    max_workers = 6
+
+    def __init__(self, repos_root, repo_names, upstream_name, my_name, **kwargs):
+        """Args:
+        repos_root - directory where all repos are cloned
+        repo_names - names of repos (like 'core' or 'masterfiles')
+        upstream_name, my_name - same as for GitRepo
+        kwargs - other arguments passed to every GitRepo, like checkout_branch
+        """
+        self.repos_root = repos_root
+        self.repo_names = repo_names
+        self.upstream_name = upstream_name
+        self.my_name = my_name
+        self.kwargs = kwargs
+        self.timings = {}
+
+    def prepare_repo(self, name):
+        start = time.monotonic()
+        repo = GitRepo(
+            dirname=os.path.join(self.repos_root, name),
+            repo_name=name,
+            upstream_name=self.upstream_name,
+            my_name=self.my_name,
+            **self.kwargs
+        )
+        self.timings[name] = time.monotonic() - start
+        log.info("Prepared {} repo in {:.1f}s".format(name, self.timings[name]))
+        return repo
+
+    def prepare(self):
+        """Prepares all repos, returns list of GitRepo objects in the same
+        order as repo_names. All repos are prepared even if some of them fail
+        (a clone or fetch can't be safely interrupted anyway), and then
+        RepoPreparationException listing all failures is raised.
+        """
+        repos = {}
+        failures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.prepare_repo, n): n for n in self.repo_names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    repos[name] = future.result()
+                except Exception as e:
+                    log.error("Failed to prepare {} repo: {}".format(name, e))
+                    failures[name] = e
+        if failures:
+            raise RepoPreparationException(
+                "Failed to prepare repos: "
+                + "; ".join("{}: {}".format(n, e) for n, e in failures.items())
+            )
+        return [repos[name] for name in self.repo_names]
@@ -0,0 +1,174 @@
+import re
+import threading
+import subprocess
+import logging as log
+
+try:
+    import dulwich.repo
+    import dulwich.objects
+    import dulwich.objectspec
+    import dulwich.object_store
+except ImportError:
+    dulwich = None
+
+
+class CLIBackend:
+    """Class responsible for read-only operations on a GitRepo, done by
+    running `git` commands. Files are read by one long-running
+    `git cat-file --batch` process, so reading many files doesn't spawn a
+    process for each of them.
+    """
+
+    name = "cli"
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._cat_file_process = None
+        self._cat_file_lock = threading.Lock()
+
+    def rev_parse(self, ref):
+        """Returns SHA of object named by ref, or None if it doesn't exist"""
+        result = self.repo.run_command(
+            "rev-parse", "--verify", "--quiet", ref, capture_output=True, check=False
+        )
+        if result.returncode != 0:
+            return None
+        return result.stdout.strip()
+
+    def describe(self, ref="HEAD"):
+        """Returns name of the closest annotated tag reachable from ref"""
+        return self.repo.run_command(
+            "describe", "--abbrev=0", ref, capture_output=True
+        ).stdout.rstrip()
+
+    def read_object(self, name):
+        """Returns contents of a git object (like 'master:README.md') as bytes.
+        Raises FileNotFoundError if object doesn't exist.
+        """
+        with self._cat_file_lock:
+            if self._cat_file_process is None:
+                git_command = ["git", "-C", self.repo.dirname, "cat-file", "--batch"]
+                log.debug("running command: {}".format(" ".join(git_command)))
+                self._cat_file_process = subprocess.Popen(
+                    git_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+                )
+            process = self._cat_file_process
+            process.stdin.write(name.encode("utf-8") + b"\n")
+            process.stdin.flush()
+            header = process.stdout.readline().decode("utf-8").split()
+            if len(header) != 3:
+                # "<name> missing" or "<name> ambiguous"
+                raise FileNotFoundError("git object {} not found".format(name))
+            (sha, object_type, size) = header
+            data = process.stdout.read(int(size))
+            process.stdout.read(1)  # trailing newline
+            return data
+
+    def close(self):
+        """Stops `git cat-file` process started by read_object, if any"""
+        with self._cat_file_lock:
+            if self._cat_file_process is not None:
+                self._cat_file_process.stdin.close()
+                self._cat_file_process.wait()
+                self._cat_file_process = None
+
+
+class DulwichBackend(CLIBackend):
+    """Class responsible for read-only operations on a GitRepo, done in
+    the current process with dulwich library - without spawning `git`.
+    Understands refs, SHAs, `<ref>^{commit}` and `<ref>:<path>` names.
+    Anything else (like `HEAD~2`, or objects missing in a partial clone) is
+    passed to CLIBackend.
+    describe() is always done by CLIBackend, since choosing the closest tag
+    in merge history the same way as `git describe` isn't trivial, and the
+    result is used for naming new release tags.
+    """
+
+    name = "dulwich"
+
+    def __init__(self, repo):
+        super().__init__(repo)
+        self._lock = threading.Lock()
+        self._repo = None
+        # fail early if repo can't be opened by dulwich
+        self.open()
+
+    def open(self):
+        if self._repo is None:
+            self._repo = dulwich.repo.Repo(self.repo.dirname)
+        return self._repo
+
+    def resolve(self, repo, ref):
+        """Returns object named by ref, raises KeyError if there is no such
+        object, or NotImplementedError if ref syntax is not supported
+        """
+        if ":" in ref:
+            (ref, path) = ref.split(":", 1)
+            tree = self.peel(repo, self.resolve(repo, ref), dulwich.objects.Commit)
+            if path == "":
+                return repo[tree.tree]
+            (mode, sha) = dulwich.object_store.tree_lookup_path(
+                repo.__getitem__, tree.tree, path.encode("utf-8")
+            )
+            return repo[sha]
+        if ref.endswith("^{commit}"):
+            obj = self.resolve(repo, ref[: -len("^{commit}")])
+            return self.peel(repo, obj, dulwich.objects.Commit)
+        if not re.match("^[A-Za-z0-9_./-]+$", ref):
+            raise NotImplementedError(ref)
+        if re.match("^[0-9a-f]{40}$", ref):
+            return repo[ref.encode("ascii")]
+        name = dulwich.objectspec.parse_ref(repo.refs, ref.encode("utf-8"))
+        return repo[repo.refs[name]]
+
+    def peel(self, repo, obj, object_class):
+        while isinstance(obj, dulwich.objects.Tag):
+            obj = repo[obj.object[1]]
+        if not isinstance(obj, object_class):
+            raise KeyError(obj.id)
+        return obj
+
+    def rev_parse(self, ref):
+        try:
+            with self._lock:
+                return self.resolve(self.open(), ref).id.decode("ascii")
+        except (KeyError, NotImplementedError):
+            return super().rev_parse(ref)
+
+    def read_object(self, name):
+        try:
+            with self._lock:
+                return self.resolve(self.open(), name).as_raw_string()
+        except (KeyError, NotImplementedError):
+            # missing file (CLIBackend will raise proper exception), or an
+            # object which wasn't downloaded to partial clone yet
+            return super().read_object(name)
+
+    def close(self):
+        """Forgets cached refs and packs, so that changes made by `git`
+        commands are visible
+        """
+        with self._lock:
+            if self._repo is not None:
+                self._repo.close()
+                self._repo = None
+        super().close()
+
+
+backends = {"cli": CLIBackend, "dulwich": DulwichBackend}
+
+
+def get_backend(name, repo):
+    """Returns backend with given name for repo, falling back to CLIBackend
+    if dulwich is not installed or can't open the repo
+    """
+    if name == "dulwich" and dulwich is None:
+        log.warning("dulwich is not installed, using git command line")
+        return CLIBackend(repo)
+    try:
+        return backends[name](repo)
+    except Exception as e:
+        log.warning(
+            "can't use {} git backend ({}), using git command line".format(name, e)
+        )
+        return CLIBackend(repo)
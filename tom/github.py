@@ -4,11 +4,14 @@ import re
 import os
 import sys
 import json
+import time
 import datetime
+import email.utils
 import logging as log
 import requests
 from copy import copy
 
+from tom.cache import JSONCache
 from tom.utils import pretty, write_json
 
 # Global constant, reused many times for finding emails in comments:
@@ -16,7 +19,7 @@ _EMAIL_REGEX = re.compile(r"[-_\.a-zA-Z0-9]+\@[-_\.a-zA-Z0-9]+\.[a-zA-Z]+")
 
 
 class GitHub:
-    def __init__(self, token, user_agent, known_repos):
+    def __init__(self, token, user_agent, known_repos, store=None):
         self.token = token
         self.headers = {
             "Authorization": "token {}".format(token),
@@ -24,6 +27,8 @@ class GitHub:
         }
         self.get_cache = {}
         self.known_repos = known_repos
+        # ObjectStore for immutable objects (commits, reviews), or None
+        self.store = store
 
     def path(self, path):
         if path.startswith("/"):
@@ -59,6 +64,30 @@ class GitHub:
         log.debug("paginating from {} to {}".format(path, next_link))
         return data + self.get(next_link)
 
+    def get_conditional(self, path, headers):
+        """Sends GET request with extra headers (like If-None-Match or
+        If-Modified-Since) and returns the response, which can be
+        304 Not Modified. Responses are neither cached nor paginated.
+        """
+        log.debug("GET {} {}".format(path, headers))
+        path = self.path(path)
+        r = requests.get(path, headers=dict(self.headers, **headers))
+        log.debug("RESPONSE {}".format(r.status_code))
+        if r.status_code != 304 and not (200 <= r.status_code < 300):
+            sys.exit("Non-success API response {} for '{}'".format(r.status_code, path))
+        return r
+
+    def patch(self, path, data=None):
+        if os.getenv("TOM") == "PASSIVE":
+            print("Would patch: " + path)
+            return None
+        self.api_log("PATCH {} {}".format(path, data))
+        path = self.path(path)
+        r = requests.patch(path, headers=self.headers, json=data)
+        log.debug("RESPONSE {}".format(r.status_code))
+        assert r.status_code >= 200 and r.status_code < 300, r.text
+        return r
+
     def put(self, path, data):
         log.critical("PUT has not been implemented yet!")
         raise NotImplementedError
@@ -431,6 +460,226 @@ class Comments:
         return self.comments[index]
 
 
+class CommentPoller:
+    """Class responsible for finding new comments on PRs, with one request
+    per repo instead of one per PR. Asks for comments updated since last
+    poll (watermark), which is persisted between runs with JSONCache.
+    New watermarks are saved only for repos where all new comments were
+    handled - call failed() for repos where handling some PR failed, so that
+    its comments are returned again next time.
+    """
+
+    def __init__(self, github, cache_path):
+        self.github = github
+        # {repo: {"since": timestamp, "seen": [IDs of comments at timestamp]}}
+        self.watermarks = JSONCache(cache_path)
+        # new watermarks, to be saved by save(): {repo: watermark}
+        self.pending = {}
+
+    def server_time(self, repo_url):
+        """Returns current time of GitHub server, as GitHub timestamp"""
+        r = self.github.get_conditional(repo_url + "/issues/comments?per_page=1", {})
+        date = email.utils.parsedate_to_datetime(r.headers["Date"])
+        return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def poll(self, repo, repo_url):
+        """Returns dict {PR number: [new Comment objects, oldest first]} for
+        repo, or None if it's polled for the first time (then caller should
+        look through all comments itself). Comments on issues are included
+        too, caller should ignore numbers which aren't open PRs.
+        """
+        watermark = self.watermarks.get(repo)
+        if watermark is None:
+            self.pending[repo] = {"since": self.server_time(repo_url), "seen": []}
+            return None
+        since = watermark["since"]
+        seen = set(watermark["seen"])
+        # don't change cached watermark - it's replaced only by save()
+        watermark = dict(watermark, seen=list(watermark["seen"]))
+        path = "{}/issues/comments?since={}&sort=updated&direction=asc&per_page=100"
+        comments = self.github.get(path.format(repo_url, since))
+        log.debug(
+            "{} comments in {} updated since {}".format(len(comments), repo, since)
+        )
+        new_comments = {}
+        for comment in comments:
+            # GitHub returns comments updated at `since` too, so remember
+            # which of them we've already seen
+            if comment["updated_at"] > watermark["since"]:
+                watermark = {"since": comment["updated_at"], "seen": []}
+            if (
+                comment["updated_at"] == watermark["since"]
+                and comment["id"] not in watermark["seen"]
+            ):
+                watermark["seen"].append(comment["id"])
+            # edits of old comments are not new mentions
+            if comment["created_at"] < since or comment["id"] in seen:
+                continue
+            number = int(comment["issue_url"].rsplit("/", 1)[1])
+            new_comments.setdefault(number, []).append(Comment(comment))
+        self.pending[repo] = watermark
+        return new_comments
+
+    def failed(self, repo):
+        """Keeps old watermark of repo, because some of its new comments
+        weren't handled
+        """
+        self.pending.pop(repo, None)
+
+    def save(self):
+        for repo, watermark in self.pending.items():
+            self.watermarks.store(repo, watermark)
+        self.pending = {}
+        self.watermarks.save()
+
+
+class NotificationPoller:
+    """Class responsible for finding mentions of the bot through GitHub
+    notifications, so that cost of finding them doesn't depend on number of
+    open PRs. Only notifications about mentions in PRs are handled, and only
+    latest comment of each notification thread is fetched. Caller should
+    report PRs which were handled (or failed to be handled) by handled(),
+    and only threads of handled PRs are marked as read by mark_read().
+    Other threads are left unread - for humans, or to be retried.
+    Value of Last-Modified header and time of next allowed poll (from
+    X-Poll-Interval header) are persisted between runs with JSONCache.
+    Last-Modified is not updated if handling some PR failed, so that its
+    notification is returned again next time.
+    """
+
+    reasons = ("mention", "team_mention")
+
+    def __init__(self, github, username, cache_path):
+        self.github = github
+        self.username = username
+        self.state = JSONCache(cache_path)
+        # {(repo, PR number): [thread IDs]} of mentions returned by poll()
+        self.threads = {}
+        self.handled_prs = set()
+        self.failed_prs = set()
+        self.last_modified = None
+
+    def poll(self):
+        """Returns dict {repo: {PR number: [Comment objects]}} with mentions
+        from unread notifications. Instead of list of comments, there is None
+        for PRs where mention isn't in the latest comment (so all comments
+        should be checked).
+        """
+        next_poll = self.state.get("next_poll", 0)
+        if time.time() < next_poll:
+            log.info("Not polling notifications until {}".format(time.ctime(next_poll)))
+            return {}
+        headers = {}
+        last_modified = self.state.get("last_modified")
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        r = self.github.get_conditional("/notifications?participating=true", headers)
+        poll_interval = int(r.headers.get("X-Poll-Interval", 60))
+        self.state.store("next_poll", time.time() + poll_interval)
+        if r.status_code == 304:
+            log.debug("No new notifications")
+            return {}
+        self.last_modified = r.headers.get("Last-Modified")
+        mentions = {}
+        for notification in r.json():
+            subject = notification["subject"]
+            if (
+                notification["reason"] not in self.reasons
+                or subject["type"] != "PullRequest"
+            ):
+                continue
+            if not subject.get("latest_comment_url"):
+                continue
+            if subject["latest_comment_url"] == subject["url"]:
+                continue  # mention in PR description, not in a comment
+            comment = Comment(self.github.get(subject["latest_comment_url"]))
+            repo = notification["repository"]["full_name"]
+            number = int(subject["url"].rsplit("/", 1)[1])
+            self.threads.setdefault((repo, number), []).append(notification["id"])
+            if "@" + self.username in comment:
+                mentions.setdefault(repo, {})[number] = [comment]
+            else:
+                # somebody commented after the mention
+                mentions.setdefault(repo, {})[number] = None
+        return mentions
+
+    def handled(self, repo, number, ok=True):
+        """Records that PR was handled (ok=True) or handling it failed"""
+        if ok:
+            self.handled_prs.add((repo, number))
+        else:
+            self.failed_prs.add((repo, number))
+
+    def mark_read(self):
+        """Marks threads of mentions in handled PRs as read"""
+        for pr, threads in self.threads.items():
+            if pr not in self.handled_prs:
+                continue
+            for thread in threads:
+                self.github.patch("/notifications/threads/{}".format(thread))
+        self.threads = {}
+        self.handled_prs = set()
+
+    def save(self):
+        if self.last_modified and not self.failed_prs:
+            self.state.store("last_modified", self.last_modified)
+        self.last_modified = None
+        self.failed_prs = set()
+        self.state.save()
+
+
+class EventWatcher:
+    """Class responsible for finding out which repos didn't change since
+    previous run, by asking for their events feed with If-None-Match header.
+    Response 304 Not Modified doesn't count against API rate limit, so such
+    quiet repos cost one free request. Feed isn't polled more often than
+    allowed by X-Poll-Interval header - until then, repo is treated as
+    quiet. List of open PRs of each repo is remembered, to be reused while
+    repo is quiet. State is persisted between runs with JSONCache.
+    """
+
+    def __init__(self, github, cache_path):
+        self.github = github
+        # {repo: {"etag", "next_poll", "checked" (time), "pulls"}}
+        self.state = JSONCache(cache_path)
+
+    def changed(self, repo, repo_url):
+        """Returns time when repo was checked last time if it didn't change
+        since then, or None if it changed (or it's not known)
+        """
+        state = dict(self.state.get(repo) or {})
+        now = time.time()
+        previous_check = state.get("checked") if "pulls" in state else None
+        state["checked"] = now
+        if previous_check is not None and now < state.get("next_poll", 0):
+            log.debug("Not polling events of {} yet".format(repo))
+            self.state.store(repo, state)
+            return previous_check
+        headers = {}
+        if previous_check is not None and state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        r = self.github.get_conditional(repo_url + "/events?per_page=1", headers)
+        state["next_poll"] = now + int(r.headers.get("X-Poll-Interval", 60))
+        state["etag"] = r.headers.get("ETag")
+        self.state.store(repo, state)
+        if r.status_code == 304:
+            log.info("No new events in {}".format(repo))
+            return previous_check
+        return None
+
+    def pulls(self, repo):
+        """Returns list of open PRs of repo remembered by set_pulls()"""
+        return self.state.get(repo)["pulls"]
+
+    def set_pulls(self, repo, pulls):
+        state = dict(self.state.get(repo))
+        state["pulls"] = pulls
+        self.state.store(repo, state)
+
+    def save(self):
+        self.state.save()
+
+
 class PR:
     def __init__(self, data, github):
         self.data = data  # JSON dict from GitHub API
@@ -453,6 +702,7 @@ class PR:
         self.api_url = data["url"]
         self.url = data["html_url"]
         self.commits_url = data["commits_url"]
+        self.head_sha = data.get("head", {}).get("sha")
         self.reviews_url = self.api_url + "/reviews"
         self.requested_reviewers = data["requested_reviewers"]
 
@@ -554,7 +804,15 @@ class PR:
     @property
     def commits(self):
         if self._commits is None:
-            self._commits = self.github.get(self.commits_url)
+            store = self.github.store
+            if store is not None and self.head_sha:
+                # list of commits can't change as long as head stays the same
+                self._commits = store.get_commits(self.head_sha)
+                if self._commits is None:
+                    self._commits = self.github.get(self.commits_url)
+                    store.put_commits(self.head_sha, self._commits)
+            else:
+                self._commits = self.github.get(self.commits_url)
         return self._commits
 
     @property
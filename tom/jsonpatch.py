@@ -0,0 +1,113 @@
+import re
+import json
+import collections
+
+
+class JSONPatcher:
+    """Class responsible for changing values in a JSON file without
+    re-serializing all of it. Order of keys is preserved, new keys are
+    appended to the end of their object, and only text of changed values is
+    generated - the rest of the file is left as is. Result is identical to
+    json.dumps(data, indent=indent) if the original file was formatted the
+    same way.
+    Example:
+        patcher = JSONPatcher(repo.get_file("packages_mapping.json"))
+        patcher.set(["packages", "3.21.4"], packages)
+        repo.put_file("packages_mapping.json", str(patcher))
+    """
+
+    whitespace = re.compile("[ \t\n\r]*")
+
+    def __init__(self, text, indent=2, rewrite=False):
+        """Args:
+        text - contents of JSON file, raises json.decoder.JSONDecodeError
+            if it's not a valid JSON
+        indent - indentation used in the file
+        rewrite - set to True to re-serialize whole file instead of patching
+            only changed parts
+        """
+        self.data = json.loads(text, object_pairs_hook=collections.OrderedDict)
+        self.text = text
+        self.indent = indent
+        self.rewrite = rewrite
+        self.decoder = json.JSONDecoder()
+
+    def __str__(self):
+        if self.rewrite:
+            return json.dumps(self.data, indent=self.indent)
+        return self.text
+
+    def set(self, path, value):
+        """Sets value at path (list of keys), like data[a][b] = value.
+        All objects except the last one must exist.
+        """
+        parent = self.data
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = value
+        if not self.rewrite:
+            self.patch(path, value)
+
+    def skip_whitespace(self, pos):
+        return self.whitespace.match(self.text, pos).end()
+
+    def find_object(self, path):
+        """Returns position of opening brace of object at path"""
+        pos = self.skip_whitespace(0)
+        for key in path:
+            (member, _) = self.find_member(pos, key)
+            if member is None:
+                raise KeyError(key)
+            pos = member[0]
+        return pos
+
+    def find_member(self, pos, key):
+        """Given position of opening brace of an object, finds member with
+        given key in it. Returns tuple (start and end of member value, or None
+        if there is no such key; position of end of last member, or of opening
+        brace if object is empty)
+        """
+        pos = self.skip_whitespace(pos + 1)
+        last_end = pos - 1
+        while self.text[pos] != "}":
+            (member_key, pos) = json.decoder.scanstring(self.text, pos + 1)
+            pos = self.skip_whitespace(pos)
+            start = self.skip_whitespace(pos + 1)  # skip colon
+            (_, end) = self.decoder.raw_decode(self.text, start)
+            if member_key == key:
+                return ((start, end), end)
+            last_end = end
+            pos = self.skip_whitespace(end)
+            if self.text[pos] == ",":
+                pos = self.skip_whitespace(pos + 1)
+        return (None, last_end)
+
+    def dumps(self, value, depth):
+        """Serializes value to be placed at given depth in the file"""
+        text = json.dumps(value, indent=self.indent)
+        return text.replace("\n", "\n" + " " * (self.indent * depth))
+
+    def patch(self, path, value):
+        start = self.find_object(path[:-1])
+        depth = len(path)
+        (member, last_end) = self.find_member(start, path[-1])
+        if member is not None:
+            (value_start, value_end) = member
+            self.text = (
+                self.text[:value_start]
+                + self.dumps(value, depth)
+                + self.text[value_end:]
+            )
+            return
+        new_member = "\n{}{}: {}".format(
+            " " * (self.indent * depth),
+            json.dumps(path[-1]),
+            self.dumps(value, depth),
+        )
+        if last_end == start:
+            # object was empty, so we also need to indent its closing brace
+            end = self.text.index("}", start)
+            new_member = "{}\n{}".format(new_member, " " * (self.indent * (depth - 1)))
+            self.text = self.text[: start + 1] + new_member + self.text[end:]
+        else:
+            self.text = self.text[:last_end] + "," + new_member + self.text[last_end:]
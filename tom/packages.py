@@ -1,9 +1,15 @@
+import os
 import re
 import json
-import requests
-import collections
 import datetime
+import threading
+import urllib.parse
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+from tom.cache import JSONCache
 from tom.git import GitRepo
+from tom.jsonpatch import JSONPatcher
+from tom.sessions import SessionPool
 
 
 class PackageMapperException(Exception):
@@ -51,15 +57,121 @@ def is_branch_or_version(string):
     return None
 
 
+class ReleaseFetcher:
+    """Class responsible for downloading release data JSON files.
+    Downloaded files are kept in cache together with their ETags, and next
+    time they are downloaded only if they were changed on server (otherwise
+    server replies with 304 Not Modified and cached copy is used). Files
+    not requested for `ttl` seconds (like ones of old releases) are dropped
+    from cache.
+    Safe to use from several threads.
+    """
+
+    ttl = 30 * 24 * 60 * 60
+
+    def __init__(self, cache_path, sessions=None):
+        self.cache = JSONCache(cache_path, ttl=self.ttl)
+        self.sessions = sessions or SessionPool()
+
+    def get_json(self, url):
+        """Downloads and parses JSON file, revalidating cached copy if any"""
+        cached = self.cache.get(url)
+        headers = {}
+        if cached is not None:
+            headers["If-None-Match"] = cached["etag"]
+        r = self.sessions.get(url, headers=headers)
+        if cached is not None and r.status_code == 304:
+            log.debug("{} not modified, using cached copy".format(url))
+            self.cache.store(url, cached)  # still in use, keep it for longer
+            return cached["data"]
+        if not r.ok:
+            raise URLDownloadFailureException(
+                "failed to download %s, return code %d" % (url, r.status_code)
+            )
+        try:
+            data = r.json()
+        except json.decoder.JSONDecodeError as e:
+            raise JSONParsingError("file %s is not a valid JSON" % url) from e
+        etag = r.headers.get("ETag")
+        if etag:
+            self.cache.store(url, {"etag": etag, "data": data})
+        return data
+
+    def save(self):
+        self.cache.save()
+
+
+class URLVerifier:
+    """Class responsible for checking that package URLs can be downloaded.
+    URLs are checked with HEAD requests, concurrently, but with at most
+    max_per_host requests to the same host at a time. Successfully checked
+    URLs are remembered (for `ttl` seconds), so they are not checked again
+    on next runs - released packages don't disappear.
+    """
+
+    max_workers = 32
+    max_per_host = 8
+    ttl = 30 * 24 * 60 * 60
+
+    def __init__(self, cache_path):
+        self.cache = JSONCache(cache_path, ttl=self.ttl)
+        self.sessions = SessionPool(pool_size=self.max_per_host)
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+
+    def host_semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.Semaphore(self.max_per_host)
+            return self._host_semaphores[host]
+
+    def check(self, url):
+        """Returns None if URL can be downloaded, or description of error"""
+        if self.cache.get(url):
+            return None
+        try:
+            with self.host_semaphore(url):
+                r = self.sessions.head(url, allow_redirects=True, timeout=30)
+        except Exception as e:
+            return str(e)
+        if not r.ok:
+            return "return code %d" % r.status_code
+        self.cache.store(url, True)
+        return None
+
+    def verify(self, urls):
+        """Checks all URLs, returns dict {url: error} of failed ones"""
+        urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            errors = dict(zip(urls, pool.map(self.check, urls)))
+        self.cache.save()
+        return {url: error for url, error in errors.items() if error is not None}
+
+
 class PackageMapper:
     """Class responsible for updating packages_mapping.json file
     Currently it's tailored for cfengine needs.
     """
 
-    def __init__(self, github, slack, dispatcher, username):
+    # we need only current versions of a few files, not contents of whole history
+    clone_filter = "blob:none"
+    # JSON files are patched, changing only text of new or changed values -
+    # set it to True to re-serialize them completely instead
+    rewrite_json = False
+
+    releases_url = "https://cfengine.com/release-data/%s/releases.json"
+    # (product, codename) pairs
+    products = [("community", "community"), ("enterprise", "nova")]
+    # how many files can be downloaded at the same time
+    max_workers = 8
+
+    def __init__(self, github, slack, dispatcher, username, cache_dir="."):
         self.github = github
         self.slack = slack
         self.username = username
+        self.fetcher = ReleaseFetcher(os.path.join(cache_dir, "release-data.json"))
+        self.verifier = URLVerifier(os.path.join(cache_dir, "verified-urls.json"))
         dispatcher.register_command(
             keyword="packages_mapping",
             callback=lambda branches: self.run(branches),
@@ -74,27 +186,23 @@ class PackageMapper:
         repo_name = "system-testing"
         upstream_name = "cfengine"
         local_path = "../" + repo_name
-        repo = GitRepo(local_path, repo_name, upstream_name, self.username, "master")
+        repo = GitRepo(
+            local_path,
+            repo_name,
+            upstream_name,
+            self.username,
+            "master",
+            clone_filter=self.clone_filter,
+        )
         timestamp = re.sub("[^0-9-]", "_", str(datetime.datetime.today()))
         new_branchname = "packages_mapping-{}".format(timestamp)
         repo.checkout(new_branchname, new=True)
-        # load current file
+        # load current files, all changes are applied to them in memory and
+        # then written and committed at once
         packages_mapping_file_path = "deployment_tests/packages_mapping.json"
-        try:
-            packages_mapping_contents = repo.get_file(packages_mapping_file_path)
-        except FileNotFoundError as e:
-            raise RepoFileNotFoundException(
-                "file %s not found in repo. Is repo broken?"
-                % packages_mapping_file_path
-            ) from e
-        try:
-            packages_mapping = json.loads(
-                packages_mapping_contents, object_pairs_hook=collections.OrderedDict
-            )
-        except json.decoder.JSONDecodeError as e:
-            raise JSONParsingError(
-                "file %s is not a valid JSON" % packages_mapping_file_path
-            ) from e
+        packages_mapping = self.load_json(repo, packages_mapping_file_path, indent=2)
+        upgrade_from_file_path = "deployment_tests/upgrade_from.json"
+        upgrade_from = self.load_json(repo, upgrade_from_file_path, indent=4)
 
         # sample of the file
         # {
@@ -105,76 +213,23 @@ class PackageMapper:
         #           "PACKAGES_i386_linux_debian_4": {
         #             "url": "https://cfengine-package-repos.s3.amazonaws.com/community_binaries/cfengine-community_3.6.6-1_i386.deb"
         #           },
-        for value in inputs.split(","):
-            value_type = is_branch_or_version(value)
-            assert value_type, "couldn't decide if [%s] is branch or version" % value
+        releases = self.get_releases(inputs.split(","))
+        failures = self.verify_packages(releases)
+        versions = []
+        for value, branch, version, packages_by_codename in releases:
             self.slack.reply(
-                "Updating packages mapping for %s %s " % (value_type, value)
+                "Updating packages mapping for %s %s "
+                % (is_branch_or_version(value), value)
             )
             result = {"agent": {}, "hub": {}}
-            for product, codename in [
-                ("community", "community"),
-                ("enterprise", "nova"),
-            ]:
-                if value_type == "version":
-                    version = value
-                    branch = re.sub("^(\\d+\\.\\d+\\.).*", "\\1x", version)
-                else:
-                    branch = value
-
-                releases_url = (
-                    "https://cfengine.com/release-data/%s/releases.json" % product
-                )
-                releases_request = requests.get(releases_url)
-                if not releases_request.ok:
-                    raise URLDownloadFailureException(
-                        "failed to download %s, return code %d"
-                        % (releases_url, releases_request.status_code)
-                    )
-                try:
-                    releases_data = releases_request.json()
-                except json.decoder.JSONDecodeError as e:
-                    raise JSONParsingError(
-                        "file %s is not a valid JSON" % releases_url
-                    ) from e
-                if "releases" not in releases_data:
-                    raise JSONStructureError('no "releases" in %s JSON' % releases_url)
-                if value_type == "version":
-                    try:
-                        release_url = next(
-                            (release["URL"])
-                            for release in releases_data["releases"]
-                            if release["version"] == version
-                        )
-                    except StopIteration as e:
-                        raise JSONStructureError(
-                            'no release with "version"=="%s" in %s JSON'
-                            % (version, releases_url)
-                        ) from e
-                else:
-                    try:
-                        release_url, version = next(
-                            (release["URL"], release["version"])
-                            for release in releases_data["releases"]
-                            if "lts_branch" in release
-                            and release["lts_branch"] == branch
-                            and "latest_on_branch" in release
-                            and release["latest_on_branch"]
-                        )
-                    except StopIteration as e:
-                        raise JSONStructureError(
-                            'no release with "lts_branch"=="%s" and "latest_on_branch"==true in %s JSON'
-                            % (branch, releases_url)
-                        ) from e
-
-                packages = self.collect_packages(release_url)
+            for codename, packages in packages_by_codename.items():
                 # masterfiles hack #1: different parts of code expect the package to be called differently.
                 # Instead of fixing it properly, we will just support both namings
                 packages["VIRTUAL_PACKAGES_masterfiles"] = packages[
                     "PACKAGES_VIRTUAL_PACKAGES_masterfiles"
                 ]
                 # sort packages into agent/hub ones
-                if product == "community":
+                if codename == "community":
                     # for community, they are the same
                     hub_packages = agent_packages = packages
                 else:
@@ -192,34 +247,15 @@ class PackageMapper:
                     }
                 result["agent"][codename] = agent_packages
                 result["hub"][codename] = hub_packages
-            # note that following code uses "branch" and "version" variables
-            # they are left from last iteration of the above loop and should be
-            # the same in all loop iterations
-            packages_mapping["packages"][version] = result
-            repo.put_file(
-                packages_mapping_file_path, json.dumps(packages_mapping, indent=2)
-            )
+            packages_mapping.set(["packages", version], result)
             # update version in upgrade_from.json
             branch_nox = re.sub("\\.x$", "", branch)
-            upgrade_from_file_path = "deployment_tests/upgrade_from.json"
-            try:
-                upgrade_from_content = repo.get_file(upgrade_from_file_path)
-            except FileNotFoundError as e:
-                raise RepoFileNotFoundException(
-                    "file %s not found in repo. Is repo broken?"
-                    % upgrade_from_file_path
-                ) from e
-            try:
-                upgrade_from = json.loads(
-                    upgrade_from_content, object_pairs_hook=collections.OrderedDict
-                )
-            except json.decoder.JSONDecodeError as e:
-                raise JSONParsingError(
-                    "file %s is not a valid JSON" % upgrade_from_file_path
-                ) from e
-            upgrade_from["latest_version"][branch_nox] = version
-            repo.put_file(upgrade_from_file_path, json.dumps(upgrade_from, indent=4))
-            repo.commit("Add %s packages to packages_mapping" % version)
+            upgrade_from.set(["latest_version", branch_nox], version)
+            versions.append(version)
+        transaction = repo.transaction()
+        transaction.put_file(packages_mapping_file_path, str(packages_mapping))
+        transaction.put_file(upgrade_from_file_path, str(upgrade_from))
+        transaction.commit("Add %s packages to packages_mapping" % ", ".join(versions))
         repo.push(new_branchname)
         pr_text = self.github.create_pr(
             target_repo="{}/{}".format(upstream_name, repo_name),
@@ -227,22 +263,123 @@ class PackageMapper:
             source_user=self.username,
             source_branch=new_branchname,
             title="Add %s packages to packages_mapping" % inputs,
-            text="",
+            text=failures or "",
         )
         self.slack.reply(pr_text, True)
 
-    def collect_packages(self, url):
-        """Given a release URL, returns a dict where keys are platform names, and values are {'url': 'http...'}"""
-        release_request = requests.get(url)
-        if not release_request.ok:
-            raise URLDownloadFailureException(
-                "failed to download %s, return code %d"
-                % (url, release_request.status_code)
-            )
+    def load_json(self, repo, path, indent):
+        """Reads JSON file from repo, returns JSONPatcher for it"""
         try:
-            release_data = release_request.json()
+            contents = repo.get_file(path)
+        except FileNotFoundError as e:
+            raise RepoFileNotFoundException(
+                "file %s not found in repo. Is repo broken?" % path
+            ) from e
+        try:
+            return JSONPatcher(contents, indent, rewrite=self.rewrite_json)
         except json.decoder.JSONDecodeError as e:
-            raise JSONParsingError("file %s is not a valid JSON" % url) from e
+            raise JSONParsingError("file %s is not a valid JSON" % path) from e
+
+    def verify_packages(self, releases):
+        """Checks that URLs of all packages of releases (as returned by
+        get_releases) can be downloaded. Reports failures and returns their
+        summary, or None if there were no failures.
+        """
+        urls = [
+            package["url"]
+            for (_, _, _, packages_by_codename) in releases
+            for packages in packages_by_codename.values()
+            for package in packages.values()
+        ]
+        errors = self.verifier.verify(urls)
+        if not errors:
+            log.info("All %d package URLs are OK" % len(set(urls)))
+            return None
+        summary = "%d of %d package URLs failed verification:\n```\n%s\n```" % (
+            len(errors),
+            len(set(urls)),
+            "\n".join("%s: %s" % (url, error) for url, error in sorted(errors.items())),
+        )
+        self.slack.reply(summary)
+        return summary
+
+    def find_release(self, releases_url, releases_data, value):
+        """Finds release for a branch or version in releases.json of some
+        product, returns its (URL, version)
+        """
+        if "releases" not in releases_data:
+            raise JSONStructureError('no "releases" in %s JSON' % releases_url)
+        if is_branch_or_version(value) == "version":
+            try:
+                return next(
+                    (release["URL"], release["version"])
+                    for release in releases_data["releases"]
+                    if release["version"] == value
+                )
+            except StopIteration as e:
+                raise JSONStructureError(
+                    'no release with "version"=="%s" in %s JSON' % (value, releases_url)
+                ) from e
+        try:
+            return next(
+                (release["URL"], release["version"])
+                for release in releases_data["releases"]
+                if "lts_branch" in release
+                and release["lts_branch"] == value
+                and "latest_on_branch" in release
+                and release["latest_on_branch"]
+            )
+        except StopIteration as e:
+            raise JSONStructureError(
+                'no release with "lts_branch"=="%s" and "latest_on_branch"==true in %s JSON'
+                % (value, releases_url)
+            ) from e
+
+    def get_releases(self, values):
+        """For each of values (branches or versions), finds corresponding
+        release of every product and collects its packages.
+        releases.json of each product is downloaded once, and packages of all
+        releases are collected concurrently.
+        Returns list of (value, branch, version, {codename: packages}) tuples
+        """
+        for value in values:
+            value_type = is_branch_or_version(value)
+            assert value_type, "couldn't decide if [%s] is branch or version" % value
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            releases_urls = [
+                self.releases_url % product for product, _ in self.products
+            ]
+            releases_data = list(pool.map(self.fetcher.get_json, releases_urls))
+            releases = [
+                [
+                    self.find_release(url, data, value)
+                    for url, data in zip(releases_urls, releases_data)
+                ]
+                for value in values
+            ]
+            packages = [
+                pool.map(self.collect_packages, (url for url, _ in value_releases))
+                for value_releases in releases
+            ]
+            result = []
+            for value, value_releases, value_packages in zip(
+                values, releases, packages
+            ):
+                # version should be the same for all products, take the last one
+                version = value_releases[-1][1]
+                branch = re.sub("^(\\d+\\.\\d+\\.).*", "\\1x", version)
+                if is_branch_or_version(value) == "branch":
+                    branch = value
+                codenames = [codename for _, codename in self.products]
+                result.append(
+                    (value, branch, version, dict(zip(codenames, value_packages)))
+                )
+        self.fetcher.save()
+        return result
+
+    def collect_packages(self, url):
+        """Given a release URL, returns a dict where keys are platform names, and values are {'url': 'http...'}"""
+        release_data = self.fetcher.get_json(url)
         if "artifacts" not in release_data:
             raise JSONStructureError('no "artifacts" in %s JSON' % url)
         # release_data['artifacts'] is a dictionary (called 'table'), each element is a list
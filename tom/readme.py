@@ -0,0 +1,147 @@
+import re
+import collections
+import logging as log
+
+
+class DepsReadme:
+    """Parsed README file of buildscripts repo, indexed by dependency name.
+    Understands two kinds of lines mentioning dependencies:
+    * list items (in deps-packaging/README.md), like
+      `* [zlib](http://www.zlib.net/) 1.2.11`
+    * rows of version tables (in README.md), like
+      `| [zlib](http://www.zlib.net/) | 1.2.11 | 1.2.13 | |`
+    File is parsed once, changes are applied to individual lines, and the
+    whole file is assembled again only by str().
+    """
+
+    list_item_regex = re.compile("\\* \\[([^\\]]*)\\]\\(")
+    # Sample line:
+    # | [PHP](http://php.net/) ...
+    # For it, in regexp below,
+    # \[([a-z0-9-]*)\] will match [PHP]
+    # \((.*?)\) will match (http://php.net/)
+    table_row_regex = re.compile("\\| \\[([a-z0-9-]*)\\]\\((.*?)\\) ", re.IGNORECASE)
+    note_regex = re.compile("\\| ([^|]*) \\|$")
+
+    def __init__(self, text):
+        self.lines = text.split("\n")
+        # list items: {dep: [line numbers]}
+        self.items = collections.defaultdict(list)
+        # version tables, each one is a dict with header line number, widths
+        # of first and last columns, and parsed rows
+        self.tables = []
+        self.parse()
+
+    def __str__(self):
+        return "\n".join(self.lines)
+
+    def parse(self):
+        table = None
+        in_hub = False  # flag that we're in Hub section
+        for i, line in enumerate(self.lines):
+            for match in self.list_item_regex.finditer(line):
+                self.items[match.group(1).lower()].append(i)
+            if " Hub " in line:
+                in_hub = True
+            if not line.startswith("| "):
+                continue
+            if line.startswith("| CFEngine version "):
+                # Width of source columns
+                column_widths = [len(x) for x in line.split("|")]
+                # Note that first and last column widths are zero, since line
+                # begins and ends with '|'. We're actually interested in widths
+                # of first column (with words "CFEngine version" in it) and,
+                # possibly, last ("Notes").
+                # Also we substract 2 to remove column "padding".
+                table = {
+                    "header": i,
+                    "separator": None,
+                    "has_notes": "Notes" in line,
+                    "first_width": column_widths[1] - 2,
+                    "notes_width": column_widths[-2] - 2,
+                    "rows": [],
+                }
+                self.tables.append(table)
+            elif table is None:
+                log.warn("table row outside of version table: [%s]", line)
+            elif line.startswith("| --"):
+                table["separator"] = i
+            else:
+                match = self.table_row_regex.match(line)
+                if not match:
+                    log.warn("didn't find dep in line [%s]", line)
+                    continue
+                note = ""
+                if table["has_notes"]:
+                    note = self.note_regex.search(line)
+                    if not note:
+                        log.warn("didn't find note in line [%s]", line)
+                        note = ""
+                    else:
+                        note = note.group(1)
+                dep = match.group(1).lower()
+                if in_hub:
+                    dep = re.sub("-hub$", "", dep)
+                table["rows"].append(
+                    {
+                        "line": i,
+                        "dep": dep,
+                        "link": "[%s](%s)" % (match.group(1), match.group(2)),
+                        "note": note,
+                    }
+                )
+
+    def replace_version(self, dep, old_version, new_version):
+        """Replaces old_version with new_version in list items of dep"""
+        for i in self.items.get(dep.lower(), []):
+            self.lines[i] = self.lines[i].replace(old_version, new_version)
+
+    def update_tables(self, branches, deps_table):
+        """Regenerates all version tables to have one column per branch.
+        deps_table is a 2d dict: deps_table[dep][branch]=version
+        """
+        branch_column_widths = {
+            branch: max(
+                [len(branch)]
+                + [len(versions.get(branch, "-")) for versions in deps_table.values()]
+            )
+            for branch in branches
+        }
+        for table in self.tables:
+            has_notes = table["has_notes"]
+            column_widths = (
+                [table["first_width"]]  # "CFEngine version"
+                + [branch_column_widths[branch] for branch in branches]
+                + ([table["notes_width"]] if has_notes else [])  # "Notes"
+            )
+
+            def format_row(row):
+                return (
+                    "| "
+                    + " | ".join(
+                        val.ljust(width) for val, width in zip(row, column_widths)
+                    )
+                    + " |"
+                )
+
+            self.lines[table["header"]] = format_row(
+                ["CFEngine version"] + branches + (["Notes"] if has_notes else [])
+            )
+            if table["separator"] is not None:
+                self.lines[table["separator"]] = format_row(
+                    ["-" * width for width in column_widths]
+                )
+            for row in table["rows"]:
+                versions = deps_table.get(row["dep"])
+                if versions is None:
+                    log.warn(
+                        "unknown dependency in README: [%s] line [%s], will be EMPTY",
+                        row["dep"],
+                        self.lines[row["line"]],
+                    )
+                    versions = {}
+                self.lines[row["line"]] = format_row(
+                    [row["link"]]
+                    + [versions.get(branch, "-") for branch in branches]
+                    + ([row["note"]] if has_notes else [])
+                )
@@ -0,0 +1,131 @@
+import time
+import heapq
+import calendar
+import datetime
+import itertools
+import collections
+import logging as log
+
+from tom.cache import JSONCache
+
+
+def parse_time(timestamp):
+    """Converts GitHub timestamp (like '2024-01-01T00:00:00Z') to seconds
+    since epoch
+    """
+    parsed = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+    return calendar.timegm(parsed.timetuple())
+
+
+class RepoScheduler:
+    """Class responsible for deciding which repos to poll in current run.
+    Repos are polled less often the longer nothing happened in them: time
+    between polls is activity_factor times time since last activity (PR
+    update or comment), but never more than max_interval. So repos where
+    something happened recently are polled on every run, and dormant ones
+    only every max_interval seconds.
+    Time of last poll and activity, and list of open PRs (to be reused
+    between polls) of each repo are persisted between runs with JSONCache.
+    """
+
+    activity_factor = 0.1
+
+    def __init__(self, cache_path, max_interval):
+        self.max_interval = max_interval
+        # {repo: {"polled": time, "activity": time, "pulls": [PRs]}}
+        self.state = JSONCache(cache_path)
+
+    def interval(self, repo):
+        """Returns how many seconds should pass between polls of repo"""
+        state = self.state.get(repo)
+        if state is None:
+            return 0
+        idle = time.time() - state["activity"]
+        return min(self.max_interval, max(0, idle * self.activity_factor))
+
+    def due(self, repo):
+        state = self.state.get(repo)
+        if state is None:
+            return True
+        return time.time() - state["polled"] >= self.interval(repo)
+
+    def last_poll(self, repo):
+        return self.state.get(repo)["polled"]
+
+    def pulls(self, repo):
+        return self.state.get(repo)["pulls"]
+
+    def polled(self, repo, pulls):
+        """Remembers that repo was polled now, and had given open PRs"""
+        state = dict(self.state.get(repo) or {"activity": 0})
+        state["polled"] = time.time()
+        state["pulls"] = pulls
+        for pull in pulls:
+            state["activity"] = max(state["activity"], parse_time(pull["updated_at"]))
+        self.state.store(repo, state)
+
+    def record_activity(self, repo, timestamp):
+        """Remembers activity (like a comment) in repo at given GitHub
+        timestamp
+        """
+        state = self.state.get(repo)
+        if state is None:
+            return
+        activity = parse_time(timestamp)
+        if activity > state["activity"]:
+            log.debug("Activity in {} at {}".format(repo, timestamp))
+            self.state.store(repo, dict(state, activity=activity))
+
+    def save(self):
+        self.state.save()
+
+
+class WorkQueue:
+    """Priority queue of work done in one run of the bot. Items with lower
+    priority number are handled first, items with equal priorities - in
+    order in which they were added. Time each item waited in queue (from
+    adding until it was taken out) is recorded for every priority.
+    """
+
+    MENTIONS = 0
+    REVIEWS = 1
+    REPORTS = 2
+    names = {MENTIONS: "mentions", REVIEWS: "reviews", REPORTS: "reports"}
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        # {priority: [seconds waited]}
+        self.waits = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, priority, item):
+        entry = (priority, next(self._counter), time.monotonic(), item)
+        heapq.heappush(self._heap, entry)
+
+    def get(self):
+        (priority, _, added, item) = heapq.heappop(self._heap)
+        self.waits[priority].append(time.monotonic() - added)
+        return item
+
+    def __iter__(self):
+        while self._heap:
+            yield self.get()
+
+    def summary(self):
+        """Returns one line per priority, with number of handled items and
+        average and maximum time they waited in queue
+        """
+        lines = []
+        for priority, waits in sorted(self.waits.items()):
+            lines.append(
+                "{}: {} items, waited {:.1f}s on average, {:.1f}s at most".format(
+                    self.names.get(priority, priority),
+                    len(waits),
+                    sum(waits) / len(waits),
+                    max(waits),
+                )
+            )
+        return "\n".join(lines)
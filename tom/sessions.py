@@ -0,0 +1,38 @@
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    """Keeps one requests.Session per host, so that many requests to the same
+    mirror reuse kept-alive connections instead of opening a new one each time.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, pool_size=10):
+        """Args:
+        pool_size - how many connections to keep open to every host, should
+            be at least the number of threads doing requests concurrently
+        """
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """Returns session for host of given URL, creating it if needed"""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def head(self, url, **kwargs):
+        return self.session(url).head(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session(url).get(url, **kwargs)
@@ -0,0 +1,124 @@
+import os
+import json
+import sqlite3
+import threading
+
+
+class ObjectStore:
+    """Persistent store of GitHub objects which never change once created,
+    kept in an SQLite database between runs.
+    Objects are stored by kind and key, for example commits by SHA. Lists
+    of commits of a PR are stored by SHA of PR head - as long as head
+    doesn't change, neither does the list. Results of checks done on such
+    objects (verdicts) can be stored by SHA too.
+    Database is opened on first use; safe to use from several threads.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS objects (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (kind, key)
+        );
+        CREATE TABLE IF NOT EXISTS commit_lists (
+            head_sha TEXT PRIMARY KEY,
+            shas TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS verdicts (
+            sha TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (sha, name)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def open(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(self.schema)
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get(self, kind, key):
+        """Returns stored object, or None if it's not known"""
+        with self._lock:
+            row = (
+                self.open()
+                .execute(
+                    "SELECT data FROM objects WHERE kind = ? AND key = ?",
+                    (kind, str(key)),
+                )
+                .fetchone()
+            )
+        return None if row is None else json.loads(row[0])
+
+    def put_many(self, kind, objects, key="id"):
+        """Stores list of objects (dicts), using object[key] as their keys"""
+        rows = [(kind, str(obj[key]), json.dumps(obj)) for obj in objects]
+        with self._lock, self.open() as db:
+            db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", rows)
+
+    def get_commits(self, head_sha):
+        """Returns list of commits of a PR with given head, or None if it's
+        not known (or some of its commits are missing)
+        """
+        with self._lock:
+            db = self.open()
+            row = db.execute(
+                "SELECT shas FROM commit_lists WHERE head_sha = ?", (head_sha,)
+            ).fetchone()
+            if row is None:
+                return None
+            commits = []
+            for sha in json.loads(row[0]):
+                data = db.execute(
+                    "SELECT data FROM objects WHERE kind = 'commit' AND key = ?",
+                    (sha,),
+                ).fetchone()
+                if data is None:
+                    return None
+                commits.append(json.loads(data[0]))
+        return commits
+
+    def put_commits(self, head_sha, commits):
+        """Stores list of commits of a PR with given head"""
+        self.put_many("commit", commits, key="sha")
+        shas = json.dumps([commit["sha"] for commit in commits])
+        with self._lock, self.open() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO commit_lists VALUES (?, ?)", (head_sha, shas)
+            )
+
+    def get_verdict(self, sha, name):
+        """Returns result of check `name` stored for given SHA, or None"""
+        with self._lock:
+            row = (
+                self.open()
+                .execute(
+                    "SELECT value FROM verdicts WHERE sha = ? AND name = ?",
+                    (sha, name),
+                )
+                .fetchone()
+            )
+        return None if row is None else json.loads(row[0])
+
+    def put_verdict(self, sha, name, value):
+        with self._lock, self.open() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+                (sha, name, json.dumps(value)),
+            )
@@ -1,12 +1,14 @@
 import re
 import os
+import time
 import requests
 import subprocess
 import datetime
 import hashlib
 import urllib.request
 import logging as log
-from tom.git import GitRepo
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tom.git import GitRepo, RepoSet
 from tom.changelog import ChangelogGenerator
 
 
@@ -28,12 +30,22 @@ class TooManyArgumentsException(TagException):
     pass
 
 
+class TagPushException(TagException):
+    """Exception that is risen when tag couldn't be created or pushed in
+    some of repos (after it was removed from all of them)
+    """
+
+    pass
+
+
 class Tagger:
     """Class responsible for tagging.
     Currently it tags only for CFEngine
     """
 
     repos_root = ".."
+    # we need only history of these repos, file contents are fetched on demand
+    clone_filter = "blob:none"
     repo_names = [
         "core",
         "nova",
@@ -65,9 +77,7 @@ class Tagger:
         )
 
     def get_current_tag(self, repo):
-        return repo.run_command(
-            "describe", "--abbrev=0", capture_output=True
-        ).stdout.rstrip()
+        return repo.describe()
 
     def get_next_build_tag(self, old_tag, branch):
         if "build" in old_tag:
@@ -97,18 +107,15 @@ class Tagger:
             return None
 
     def init_repos(self, checkout_branch, checkout_tag):
-        repos = (
-            GitRepo(
-                dirname=os.path.join(self.repos_root, name),
-                repo_name=name,
-                upstream_name="cfengine",
-                my_name=self.username,
-                checkout_branch=checkout_branch,
-                checkout_tag=checkout_tag,
-            )
-            for name in self.repo_names
-        )
-        return repos
+        return RepoSet(
+            self.repos_root,
+            self.repo_names,
+            upstream_name="cfengine",
+            my_name=self.username,
+            checkout_branch=checkout_branch,
+            checkout_tag=checkout_tag,
+            clone_filter=self.clone_filter,
+        ).prepare()
 
     def init_core(self, branch):
         name = "core"
@@ -118,6 +125,7 @@ class Tagger:
             upstream_name="cfengine",
             my_name=self.username,
             checkout_branch=branch,
+            clone_filter=self.clone_filter,
         )
 
     def suggest(self, branch):
@@ -135,15 +143,132 @@ class Tagger:
                 % (next_final_tag, current_tag, branch, current_tag, next_final_tag)
             )
 
+    def get_upstream_tag(self, repo, tag):
+        """Returns SHA of commit tagged by tag in upstream repo, or None if
+        upstream doesn't have such tag
+        """
+        ref = "refs/tags/" + tag
+        remote = repo.run_command(
+            "ls-remote", "upstream", ref, ref + "^{}", capture_output=True
+        )
+        shas = {}
+        for line in remote.stdout.splitlines():
+            if line.strip():
+                sha, name = line.split()
+                shas[name] = sha
+        # annotated tags are listed twice, second time peeled to the commit
+        return shas.get(ref + "^{}", shas.get(ref))
+
+    def create_tag(self, repo, tag, message, upstream_sha, done):
+        """Creates signed tag in repo, unless upstream already has the same
+        tag at the same commit. Records completed step in done dict
+        """
+        if upstream_sha is not None:
+            head = repo.run_command("rev-parse", "HEAD", capture_output=True)
+            if upstream_sha != head.stdout.strip():
+                raise TagPushException(
+                    "tag %s already exists in upstream %s repo at commit %s"
+                    % (tag, repo.repo_name, upstream_sha)
+                )
+            log.info("Tag %s already exists in %s repo" % (tag, repo.repo_name))
+            done[repo.repo_name] = "existing"
+            return
+        repo.run_command("tag", "-s", "-a", tag, "-m", message)
+        done[repo.repo_name] = "created"
+
+    def push_tag(self, repo, tag, done):
+        """Pushes tag created by create_tag and checks that upstream has
+        exactly the same tag. Records completed step in done dict, returns
+        time it took
+        """
+        start = time.monotonic()
+        ref = "refs/tags/" + tag
+        repo.push(ref, "upstream", upstream=False)
+        done[repo.repo_name] = "pushed"
+        local_sha = repo.run_command("rev-parse", ref, capture_output=True).stdout
+        remote = repo.run_command("ls-remote", "upstream", ref, capture_output=True)
+        if remote.stdout.split()[:1] != local_sha.split():
+            raise TagPushException(
+                "tag %s in upstream %s repo differs from local one"
+                % (tag, repo.repo_name)
+            )
+        return time.monotonic() - start
+
+    def rollback_tag(self, repo, tag, step):
+        """Deletes tag created (and maybe pushed) by create_tag and push_tag"""
+        if step == "pushed":
+            repo.run_command(
+                "push", "upstream", "--delete", "refs/tags/" + tag, check=False
+            )
+        repo.run_command("tag", "-d", tag, check=False)
+
     def add_tag(self, branch, tag, checkout_branch=None, checkout_tag=None):
+        """Creates tag in all repos and pushes it to all of them at once.
+        Tags are signed one repo at a time, so that gpg never asks for
+        passphrase several times in parallel. Repos where upstream already
+        has the same tag are left as they are. If tagging fails in any repo,
+        tag is deleted from all repos where it was created or pushed
+        """
         repos = self.init_repos(checkout_branch, checkout_tag)
         message = "CFEngine %s" % tag.replace("-build", " ")
-        for repo in repos:
-            repo.run_command("tag", "-s", "-a", tag, "-m", message)
-            try:
-                repo.push(tag, "upstream")
-            except:
-                pass
+        start = time.monotonic()
+        done = {}
+        timings = {}
+        failures = {}
+        with ThreadPoolExecutor(max_workers=len(repos)) as pool:
+            upstream_shas = list(
+                pool.map(lambda repo: self.get_upstream_tag(repo, tag), repos)
+            )
+            for repo, upstream_sha in zip(repos, upstream_shas):
+                try:
+                    self.create_tag(repo, tag, message, upstream_sha, done)
+                except Exception as e:
+                    log.error("Failed to tag %s repo: %s" % (repo.repo_name, e))
+                    failures[repo.repo_name] = e
+                    break
+            futures = {}
+            if not failures:
+                futures = {
+                    pool.submit(self.push_tag, repo, tag, done): repo
+                    for repo in repos
+                    if done[repo.repo_name] == "created"
+                }
+            for future in as_completed(futures):
+                name = futures[future].repo_name
+                try:
+                    timings[name] = future.result()
+                    log.info("Tagged %s repo in %.1fs" % (name, timings[name]))
+                except Exception as e:
+                    log.error("Failed to tag %s repo: %s" % (name, e))
+                    failures[name] = e
+            if failures:
+                rollbacks = [
+                    pool.submit(self.rollback_tag, repo, tag, done[repo.repo_name])
+                    for repo in repos
+                    if done.get(repo.repo_name) in ("created", "pushed")
+                ]
+                for future in rollbacks:
+                    future.result()
+        if failures:
+            raise TagPushException(
+                "Failed to tag %s, removed it from all repos. Errors: %s"
+                % (tag, "; ".join("%s: %s" % (n, e) for n, e in failures.items()))
+            )
+        self.slack.reply(
+            "Tagged %s in %.1fs (%s)"
+            % (
+                tag,
+                time.monotonic() - start,
+                ", ".join(
+                    (
+                        "%s: %.1fs" % (repo.repo_name, timings[repo.repo_name])
+                        if repo.repo_name in timings
+                        else "%s: already tagged" % repo.repo_name
+                    )
+                    for repo in repos
+                ),
+            )
+        )
 
     def run(self, args):
         if "," in args: